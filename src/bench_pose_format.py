@@ -0,0 +1,142 @@
+# Checks that pose_format packs the same bytes the poses topic always had,
+# and that version 2 payloads decode back to what was encoded, then times
+# them against joining struct.pack results like publish_output used to, for
+# frames with 0, 1, 8 and 16 tags. Run from the repository root:
+#   python3 src/bench_pose_format.py [-n 1000] [-i 20000]
+import numpy
+import struct
+import time
+from argparse import ArgumentParser
+
+import detect
+import pose_format
+import pose_math
+import solve
+
+# How CameraNetworkTablesIO.publish_output packed the payload before pose_format
+def concat_pack_estimate(est: tuple[pose_math.Pose, float]) -> bytes:
+    pose, err = est
+    tx = pose.translation
+    q = pose.quaternion
+    return struct.pack(">fddddddd", err, tx[0], tx[1], tx[2], q[0], q[1], q[2], q[3])
+
+def concat_pack(est: solve.EstimatePair, detections: list[detect.DetectedTag], latency: float) -> bytes:
+    if est:
+        pose_data = struct.pack(">?", True)
+        pose_data += concat_pack_estimate(est.pose_a)
+        if est.pose_b is not None:
+            pose_data += struct.pack(">?", True)
+            pose_data += concat_pack_estimate(est.pose_b)
+            pose_data += struct.pack(">B", len(detections))
+        else:
+            pose_data += struct.pack(">?", False)
+        for detection in detections:
+            corners = detection.corners[0]
+            pose_data += struct.pack(
+                ">BHHHHHHHH",
+                detection.id,
+                round(corners[0][0]), round(corners[0][1]),
+                round(corners[1][0]), round(corners[1][1]),
+                round(corners[2][0]), round(corners[2][1]),
+                round(corners[3][0]), round(corners[3][1])
+            )
+    else:
+        pose_data = struct.pack(">?", False)
+    pose_data += struct.pack(">d", latency)
+    return pose_data
+
+def random_estimate(rng: numpy.random.Generator) -> tuple[pose_math.Pose, float]:
+    q = rng.normal(size=4)
+    q /= numpy.linalg.norm(q)
+    if q[0] < 0:
+        q = -q
+    return (pose_math.Pose(rng.uniform(-10, 10, size=3), q), rng.uniform(0, 2))
+
+def random_frame(rng: numpy.random.Generator, tag_count: int, two_estimates: bool) -> tuple[solve.EstimatePair, list[detect.DetectedTag]]:
+    detections = [
+        detect.DetectedTag(int(rng.integers(0, 30)), rng.uniform(0, 1280, size=(1, 4, 2)).astype(numpy.float32))
+        for _ in range(tag_count)
+    ]
+    if tag_count == 0:
+        return (None, detections)
+    est = solve.EstimatePair(
+        pose_a=random_estimate(rng),
+        pose_b=random_estimate(rng) if two_estimates else None
+    )
+    return (est, detections)
+
+def check_estimate_v2(expected: tuple[pose_math.Pose, float], actual: tuple[pose_math.Pose, float]):
+    if actual is None:
+        raise AssertionError("Version 2 estimate missing")
+    t_err = numpy.abs(expected[0].translation - actual[0].translation).max()
+    # q and -q are the same rotation
+    q_err = 1 - abs(numpy.dot(expected[0].quaternion, actual[0].quaternion))
+    if t_err > 1e-5 or q_err > 1e-8 or abs(expected[1] - actual[1]) > 1e-6:
+        raise AssertionError(f"Version 2 estimate off by {t_err:.2e} m, {q_err:.2e} quaternion")
+
+def check_v2(encoder: pose_format.PoseEncoderV2, est: solve.EstimatePair, detections: list[detect.DetectedTag], latency: float):
+    decoded_est, ids, corners, decoded_latency = pose_format.decode_v2(bytes(encoder.encode(est, detections, latency)))
+    if abs(decoded_latency - latency) > 1e-6 or ids != [detection.id for detection in detections]:
+        raise AssertionError("Version 2 latency or tag IDs differ")
+    if (est is None) != (decoded_est is None):
+        raise AssertionError("Version 2 estimates missing or extra")
+    if est is not None:
+        check_estimate_v2(est.pose_a, decoded_est.pose_a)
+        if (est.pose_b is None) != (decoded_est.pose_b is None):
+            raise AssertionError("Version 2 estimate B missing or extra")
+        if est.pose_b is not None:
+            check_estimate_v2(est.pose_b, decoded_est.pose_b)
+    if encoder.corners:
+        expected = numpy.rint(numpy.array([detection.corners[0] for detection in detections])).reshape(-1, 4, 2)
+        if not numpy.array_equal(expected, corners):
+            raise AssertionError("Version 2 corners differ")
+    elif corners is not None:
+        raise AssertionError("Version 2 corners sent when they shouldn't be")
+
+def check(count: int, rng: numpy.random.Generator):
+    encoder = pose_format.PoseEncoder()
+    encoders_v2 = [pose_format.PoseEncoderV2(True), pose_format.PoseEncoderV2(False)]
+    for i in range(count):
+        tag_count = int(rng.integers(0, 17))
+        est, detections = random_frame(rng, tag_count, tag_count == 1 and i % 2 == 0)
+        latency = rng.uniform(0, 0.1)
+        if bytes(encoder.encode(est, detections, latency)) != concat_pack(est, detections, latency):
+            raise AssertionError(f"Packed bytes differ with {tag_count} tags")
+        for encoder_v2 in encoders_v2:
+            check_v2(encoder_v2, est, detections, latency)
+
+def time_per_call(func, iterations: int) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    return (time.perf_counter() - start) / iterations
+
+def main():
+    parser = ArgumentParser(description="Poses topic packing check and benchmark")
+    parser.add_argument("-n", "--checks", type=int, default=1000, help="Random frames to check")
+    parser.add_argument("-i", "--iterations", type=int, default=20000, help="Iterations to time")
+    args = parser.parse_args()
+
+    rng = numpy.random.default_rng(1234)
+    check(args.checks, rng)
+    print(f"Checked {args.checks} random frames, version 1 bytes match and version 2 round trips")
+
+    encoders = [
+        ("v1", pose_format.PoseEncoder()),
+        ("v2", pose_format.PoseEncoderV2(True)),
+        ("v2 no corners", pose_format.PoseEncoderV2(False))
+    ]
+    print("tags  estimates  format         bytes  concat (us)  pose_format (us)")
+    for tag_count in (0, 1, 8, 16):
+        for two_estimates in ((False, True) if tag_count == 1 else (False,)):
+            est, detections = random_frame(rng, tag_count, two_estimates)
+            estimates = 0 if est is None else 2 if two_estimates else 1
+            concat_time = time_per_call(lambda: concat_pack(est, detections, 0.01), args.iterations) * 1e6
+            for name, encoder in encoders:
+                size = len(encoder.encode(est, detections, 0.01))
+                encoder_time = time_per_call(lambda: encoder.encode(est, detections, 0.01), args.iterations) * 1e6
+                concat = f"{concat_time:12.2f}" if name == "v1" else " " * 12
+                print(f"{tag_count:4} {estimates:10}  {name:13} {size:6} {concat} {encoder_time:17.2f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+# Checks that the NumPy pose math in pose_math gives the same poses as the
+# wpimath objects solving used to build, on random rotations and tag poses,
+# then times both on the same solvePnP outputs. Run from the repository root:
+#   python3 src/bench_pose_math.py [-n 1000] [-i 5000]
+import math
+import numpy
+import time
+from argparse import ArgumentParser
+from wpimath.geometry import *
+
+import pose_math
+import solve
+
+# The wpimath path PoseEstimator.solve used for a single tag
+def wpi_single_tag(tvecs: list, rvecs: list, field_to_tag: Pose3d) -> list[Pose3d]:
+    poses = []
+    for tvec, rvec in zip(tvecs, rvecs):
+        camera_to_tag_pose = solve.cvToWpi(tvec, rvec)
+        camera_to_tag = Transform3d(camera_to_tag_pose.translation(), camera_to_tag_pose.rotation())
+        field_to_camera = field_to_tag.transformBy(camera_to_tag.inverse())
+        poses.append(Pose3d(field_to_camera.translation(), field_to_camera.rotation()))
+    return poses
+
+# The wpimath path PoseEstimator.solve used for multiple tags
+def wpi_multi_tag(tvec: numpy.ndarray, rvec: numpy.ndarray) -> Pose3d:
+    camera_to_field_pose = solve.cvToWpi(tvec, rvec)
+    camera_to_field = Transform3d(camera_to_field_pose.translation(), camera_to_field_pose.rotation())
+    field_to_camera = camera_to_field.inverse()
+    return Pose3d(field_to_camera.translation(), field_to_camera.rotation())
+
+# The same paths with pose_math, as PoseEstimator.solve does them now
+def numpy_single_tag(tvecs: list, rvecs: list, tag_t: numpy.ndarray, tag_r: numpy.ndarray) -> list[pose_math.Pose]:
+    poses = []
+    for tvec, rvec in zip(tvecs, rvecs):
+        camera_to_tag = pose_math.cv_to_wpi(tvec, rvec)
+        poses.append(pose_math.to_pose(*pose_math.compose(tag_t, tag_r, *pose_math.invert(*camera_to_tag))))
+    return poses
+
+def numpy_multi_tag(tvec: numpy.ndarray, rvec: numpy.ndarray) -> pose_math.Pose:
+    camera_to_field = pose_math.cv_to_wpi(tvec, rvec)
+    return pose_math.to_pose(*pose_math.invert(*camera_to_field))
+
+def random_rvec(rng: numpy.random.Generator) -> numpy.ndarray:
+    axis = rng.normal(size=3)
+    axis /= numpy.linalg.norm(axis)
+    return (axis * rng.uniform(0, math.pi)).reshape(3, 1)
+
+def random_quaternion(rng: numpy.random.Generator) -> numpy.ndarray:
+    q = rng.normal(size=4)
+    return q / numpy.linalg.norm(q)
+
+# Largest difference between a wpimath pose and a pose_math one, with q and -q
+# counting as the same rotation
+def pose_error(expected: Pose3d, actual: pose_math.Pose) -> float:
+    tx = expected.translation()
+    q = expected.rotation().getQuaternion()
+    expected_q = numpy.array([q.W(), q.X(), q.Y(), q.Z()])
+    t_err = numpy.abs(numpy.array([tx.X(), tx.Y(), tx.Z()]) - actual.translation).max()
+    q_err = min(numpy.abs(expected_q - actual.quaternion).max(), numpy.abs(expected_q + actual.quaternion).max())
+    return max(t_err, q_err)
+
+def check(count: int, rng: numpy.random.Generator) -> float:
+    worst = 0
+    for _ in range(count):
+        tvecs = [rng.uniform(-5, 5, size=(3, 1)) for _ in range(2)]
+        rvecs = [random_rvec(rng) for _ in range(2)]
+        tag_q = random_quaternion(rng)
+        tag_t = rng.uniform(-10, 10, size=3)
+        field_to_tag = Pose3d(Translation3d(*tag_t), Rotation3d(Quaternion(*tag_q)))
+
+        expected = wpi_single_tag(tvecs, rvecs, field_to_tag)
+        actual = numpy_single_tag(tvecs, rvecs, tag_t, pose_math.quaternion_to_matrix(tag_q))
+        for e, a in zip(expected, actual):
+            worst = max(worst, pose_error(e, a))
+            if a.quaternion[0] < 0:
+                raise AssertionError("Quaternion has negative w")
+
+        worst = max(worst, pose_error(wpi_multi_tag(tvecs[0], rvecs[0]), numpy_multi_tag(tvecs[0], rvecs[0])))
+    return worst
+
+def time_per_call(func, iterations: int) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    return (time.perf_counter() - start) / iterations
+
+def main():
+    parser = ArgumentParser(description="pose_math property check and benchmark")
+    parser.add_argument("-n", "--checks", type=int, default=1000, help="Random poses to check")
+    parser.add_argument("-i", "--iterations", type=int, default=5000, help="Iterations to time")
+    args = parser.parse_args()
+
+    rng = numpy.random.default_rng(1234)
+    worst = check(args.checks, rng)
+    print(f"Checked {args.checks} random poses, largest difference {worst:.3e}")
+    if worst > 1e-9:
+        raise AssertionError("pose_math doesn't match wpimath")
+
+    tvecs = [rng.uniform(-5, 5, size=(3, 1)) for _ in range(2)]
+    rvecs = [random_rvec(rng) for _ in range(2)]
+    tag_q = random_quaternion(rng)
+    tag_t = rng.uniform(-10, 10, size=3)
+    field_to_tag = Pose3d(Translation3d(*tag_t), Rotation3d(Quaternion(*tag_q)))
+    tag_r = pose_math.quaternion_to_matrix(tag_q)
+
+    # What solving needs out of the poses, like pose_format.pack_estimate reads them
+    def wpi_single():
+        for pose in wpi_single_tag(tvecs, rvecs, field_to_tag):
+            tx = pose.translation()
+            q = pose.rotation().getQuaternion()
+            (tx.X(), tx.Y(), tx.Z(), q.W(), q.X(), q.Y(), q.Z())
+    def wpi_multi():
+        pose = wpi_multi_tag(tvecs[0], rvecs[0])
+        tx = pose.translation()
+        q = pose.rotation().getQuaternion()
+        (tx.X(), tx.Y(), tx.Z(), q.W(), q.X(), q.Y(), q.Z())
+
+    print("path          wpimath (us)  numpy (us)  saved (us)")
+    for name, wpi, np in (
+        ("single tag", wpi_single, lambda: numpy_single_tag(tvecs, rvecs, tag_t, tag_r)),
+        ("multi tag", wpi_multi, lambda: numpy_multi_tag(tvecs[0], rvecs[0]))
+    ):
+        wpi_time = time_per_call(wpi, args.iterations) * 1e6
+        np_time = time_per_call(np, args.iterations) * 1e6
+        print(f"{name:12} {wpi_time:13.2f} {np_time:11.2f} {wpi_time - np_time:11.2f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+# Compares frame throughput of the thread and process backends on a synthetic
+# frame rendered from the field layout. With --warm-start, also shows how
+# many solves were seeded from the camera's last pose, which should stay near
+# all of them however many workers share the camera. Run from the repository root:
+#   python3 src/bench_process.py [-c config.json] [-w 1,2,4,8] [-d 5] [--warm-start]
+import cv2
+import dataclasses
+import math
+import numpy
+import queue
+import threading
+import time
+from argparse import ArgumentParser
+from wpimath.geometry import *
+
+import capture
+import config
+import frame_buffer
+import frame_pool
+import process
+import process_pool
+import solve
+
+# Draws every tag in env that is in view of a camera at camera_pose
+def render_frame(env: config.TagEnvironment, calibration: config.CalibrationInfo, camera_pose: Pose3d, aruco_dict: int) -> cv2.Mat:
+    width, height = int(calibration.resolution[0]), int(calibration.resolution[1])
+    image = numpy.full((height, width, 3), 255, numpy.uint8)
+    dictionary = cv2.aruco.getPredefinedDictionary(aruco_dict)
+
+    half_sz = env.tag_size / 2.0
+    marker_size = 400
+    for tag_id, tag_pose in env.tags.items():
+        # Same corner order as PoseEstimator
+        corners = []
+        for y, z in solve.tag_corner_offsets(half_sz):
+            corner = tag_pose + Transform3d(Translation3d(0, y, z), Rotation3d())
+            corners.append(solve.wpiToCv(corner.relativeTo(camera_pose).translation()))
+        corners = numpy.array(corners)
+        if numpy.any(corners[:, 2] <= 0.1):
+            continue
+
+        image_points, _ = cv2.projectPoints(corners, numpy.zeros(3), numpy.zeros(3), calibration.matrix, calibration.distortion_coeffs)
+        image_points = image_points.reshape(4, 2).astype(numpy.float32)
+        if numpy.any(image_points < 0) or numpy.any(image_points[:, 0] >= width) or numpy.any(image_points[:, 1] >= height):
+            continue
+
+        # Detected corner order is clockwise from the marker's top left
+        marker = dictionary.generateImageMarker(tag_id, marker_size)
+        marker_points = numpy.array([[0, 0], [marker_size, 0], [marker_size, marker_size], [0, marker_size]], numpy.float32)
+        warp = cv2.getPerspectiveTransform(marker_points, image_points)
+        mask = cv2.warpPerspective(numpy.full((marker_size, marker_size), 255, numpy.uint8), warp, (width, height))
+        warped = cv2.warpPerspective(marker, warp, (width, height))
+        image[mask > 0] = cv2.cvtColor(warped, cv2.COLOR_GRAY2BGR)[mask > 0]
+    return image
+
+# Keeps the frame buffer full of copies of image, as a camera would
+def feed_frames(image: cv2.Mat, camera: config.CameraSettings, frame_queue: frame_buffer.FrameBuffer, pool: frame_pool.FramePool, stop: threading.Event):
+    while not stop.is_set():
+        buf = pool.acquire(image.shape)
+        numpy.copyto(buf, image)
+        frame_queue.put(capture.CameraFrame(
+            timestamp=time.monotonic(),
+            camera=camera.name,
+            calibration=camera.calibration,
+            image=buf,
+            rate=0,
+            pool=pool
+        ))
+        # Faster than any backend can keep up with, extra frames get dropped
+        time.sleep(0.002)
+
+def run_backend(backend: str, workers: int, duration: float, image: cv2.Mat, camera: config.CameraSettings, env: config.TagEnvironment, aruco_dict: int) -> tuple[float, float, float]:
+    frame_queue = frame_buffer.FrameBuffer()
+    result_queue = queue.PriorityQueue()
+    pool = frame_pool.FramePool(workers * 2 + 4)
+
+    if backend == "process":
+        threads = [process_pool.ProcessWorkerPool(aruco_dict, config.SharedEnvironment(env), [camera], workers, frame_queue, result_queue)]
+    else:
+        shared_env = config.SharedEnvironment(env)
+        tracking = process.create_tracking([camera])
+        tracks = process.create_pose_tracks([camera])
+        threads = [process.TagProcessThread(aruco_dict, shared_env, [camera], frame_queue, result_queue, tracking, tracks) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+
+    stop = threading.Event()
+    feeder = threading.Thread(target=feed_frames, args=(image, camera, frame_queue, pool, stop))
+    feeder.start()
+
+    # Let the workers start up before measuring
+    warmup_end = time.monotonic() + 2
+    count = 0
+    latency = 0
+    seeded = 0
+    start = None
+    while True:
+        try:
+            result = result_queue.get(timeout=1)
+        except queue.Empty:
+            continue
+        now = time.monotonic()
+        if now >= warmup_end:
+            if start is None:
+                start = now
+            elif now - start >= duration:
+                break
+            else:
+                count += 1
+                latency += now - result.frame.timestamp
+                if result.estimates is not None and result.estimates.seeded:
+                    seeded += 1
+        result.frame.release()
+
+    stop.set()
+    feeder.join()
+    for thread in threads:
+        thread.running = False
+    for thread in threads:
+        thread.join()
+    return (count / duration, latency / max(count, 1), seeded / max(count, 1))
+
+def main():
+    parser = ArgumentParser(description="Thread vs process backend throughput benchmark")
+    parser.add_argument("-c", "--config", type=str, default="config.json", help="Path to config JSON")
+    parser.add_argument("-w", "--workers", type=str, default="1,2,4", help="Comma separated worker counts")
+    parser.add_argument("-d", "--duration", type=float, default=5, help="Seconds to measure each run")
+    parser.add_argument("--warm-start", action="store_true", help="Turn on warm starts for the camera")
+    args = parser.parse_args()
+
+    conf = config.load_config(args.config)
+    env = config.load_environment(conf.environment)
+    camera = conf.cameras[0]
+    if args.warm_start:
+        camera = dataclasses.replace(camera, solver=dataclasses.replace(camera.solver, warm_start=True))
+    aruco_dict = cv2.aruco.DICT_APRILTAG_36H11 if conf.tag_family == "36h11" else cv2.aruco.DICT_APRILTAG_16H5
+
+    # Looking at the blue speaker from a couple of meters away
+    camera_pose = Pose3d(Translation3d(2.5, 5.5, 1.4), Rotation3d(0, 0, math.pi))
+    image = render_frame(env, camera.calibration, camera_pose, aruco_dict)
+
+    print("backend  workers  frames/s  latency (ms)  seeded")
+    for workers in [int(w) for w in args.workers.split(",")]:
+        for backend in ("thread", "process"):
+            rate, latency, seeded = run_backend(backend, workers, args.duration, image, camera, env, aruco_dict)
+            print(f"{backend:8} {workers:7} {rate:9.1f} {latency * 1000:13.2f} {seeded * 100:6.0f}%")
+
+if __name__ == "__main__":
+    main()
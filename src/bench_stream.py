@@ -0,0 +1,94 @@
+# Measures how much CPU the stream server uses as the number of viewers grows.
+# A camera is simulated by publishing a rendered frame at the stream rate, and
+# the viewers run in a separate process so only the server's own work is
+# counted. Run from the repository root:
+#   python3 src/bench_stream.py [-c config.json] [-v 1,2,5,10,20] [-d 5] [-u /camera/<name>.mjpg]
+import asyncio
+import cv2
+import math
+import multiprocessing
+import threading
+import time
+from argparse import ArgumentParser
+from wpimath.geometry import *
+
+import bench_process
+import config
+import web_stream
+
+async def read_stream(port: int, path: str, duration: float) -> int:
+    reader, writer = await asyncio.open_connection("localhost", port)
+    writer.write(("GET " + path + " HTTP/1.1\r\nHost: localhost\r\n\r\n").encode("latin-1"))
+    await writer.drain()
+    await reader.readuntil(b"\r\n\r\n")
+
+    frames = 0
+    end = time.monotonic() + duration
+    try:
+        while time.monotonic() < end:
+            headers = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), end - time.monotonic())
+            length = int(headers.split(b"Content-Length: ")[1].split(b"\r\n")[0])
+            await reader.readexactly(length + 2)
+            frames += 1
+    except asyncio.TimeoutError:
+        pass
+    writer.close()
+    return frames
+
+async def run_viewers(port: int, path: str, viewers: int, duration: float) -> list[int]:
+    return await asyncio.gather(*[read_stream(port, path, duration) for _ in range(viewers)])
+
+def viewer_main(port: int, path: str, viewers: int, duration: float, results: multiprocessing.Queue):
+    results.put(asyncio.run(run_viewers(port, path, viewers, duration)))
+
+# Publishes like main.py does, annotating only while someone is watching
+def publish_frames(stream: web_stream.StreamServer, camera: str, image: cv2.Mat, stop: threading.Event):
+    while not stop.is_set():
+        if stream.has_clients(camera):
+            stream.publish_frame(camera, image.copy())
+        time.sleep(1 / web_stream.max_fps)
+
+def main():
+    parser = ArgumentParser(description="Stream server CPU use vs viewer count")
+    parser.add_argument("-c", "--config", type=str, default="config.json", help="Path to config JSON")
+    parser.add_argument("-v", "--viewers", type=str, default="1,2,5,10,20", help="Comma separated viewer counts")
+    parser.add_argument("-d", "--duration", type=float, default=5, help="Seconds to measure each run")
+    parser.add_argument("-u", "--url", type=str, default="/stream.mjpg", help="Path the viewers request")
+    args = parser.parse_args()
+
+    conf = config.load_config(args.config)
+    env = config.load_environment(conf.environment)
+    camera = conf.cameras[0]
+    aruco_dict = cv2.aruco.DICT_APRILTAG_36H11 if conf.tag_family == "36h11" else cv2.aruco.DICT_APRILTAG_16H5
+    camera_pose = Pose3d(Translation3d(2.5, 5.5, 1.4), Rotation3d(0, 0, math.pi))
+    image = bench_process.render_frame(env, camera.calibration, camera_pose, aruco_dict)
+
+    stream = web_stream.StreamServer(conf.stream, [camera.name])
+    stream.start()
+    stop = threading.Event()
+    publisher = threading.Thread(target=publish_frames, args=(stream, camera.name, image, stop), daemon=True)
+    publisher.start()
+    time.sleep(1)
+
+    ctx = multiprocessing.get_context("spawn")
+    print("viewers  frames/s per viewer  server CPU (%)")
+    for viewers in [int(v) for v in args.viewers.split(",")]:
+        results = ctx.Queue()
+        viewer_process = ctx.Process(target=viewer_main, args=(conf.stream.port, args.url, viewers, args.duration, results))
+        cpu_start = time.process_time()
+        start = time.monotonic()
+        viewer_process.start()
+        frames = results.get()
+        elapsed = time.monotonic() - start
+        cpu = time.process_time() - cpu_start
+        viewer_process.join()
+
+        # Spawning the viewer process is included in elapsed, which makes the CPU slightly low
+        print(f"{viewers:7} {sum(frames) / len(frames) / args.duration:20.1f} {cpu / elapsed * 100:15.1f}")
+        # Let the encoder go idle between runs
+        time.sleep(1)
+
+    stop.set()
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,14 @@
 import cv2
+import numpy
+import os
+import queue
 import threading
 import time
-import queue
 import random
 from dataclasses import dataclass, field
 
 import config
+import frame_pool
 
 @dataclass
 class CameraParams:
@@ -14,6 +17,9 @@ class CameraParams:
     gain: int
     target_fps: int
 
+# Frames are released from whichever thread finishes with them last
+frame_refs_lock = threading.Lock()
+
 @dataclass(order=True)
 class CameraFrame:
     timestamp: float # Based on time.monotonic()
@@ -21,98 +27,401 @@ class CameraFrame:
     calibration: config.CalibrationInfo = field(compare=False)
     image: cv2.Mat = field(compare=False)
     rate: int = field(compare=False)
+    # Image is this many times smaller than the calibrated resolution
+    scale: int = field(compare=False, default=1)
+    # Pool the image buffer goes back to once the frame is done with
+    pool: frame_pool.FramePool = field(compare=False, default=None)
+    # Outputs still using the image, see retain()
+    refs: int = field(compare=False, default=1)
+    # Counts up per camera in capture order
+    seq: int = field(compare=False, default=0)
+    # MJPEG data the image was decoded from, if the source gave it. Viewers
+    # decode it in full color, whatever the detector got.
+    encoded: numpy.ndarray = field(compare=False, default=None)
+
+    # Each output that keeps the frame after the main thread is done with it
+    # takes a reference, and releases it like the main thread does
+    def retain(self):
+        with frame_refs_lock:
+            self.refs += 1
+
+    # Call once the frame has been published and streamed, the image must not
+    # be used after this. The image goes back to the pool on the last release.
+    def release(self):
+        with frame_refs_lock:
+            self.refs -= 1
+            if self.refs > 0:
+                return
+            image = self.image
+            self.image = None
+            self.encoded = None
+        if self.pool is not None and image is not None:
+            self.pool.release(image)
 
-def is_config_different(a: CameraParams, b: CameraParams) -> bool:
-    if a is None and b is None:
-        return False
+# Exposure and gain can be changed on the open device, but the frame rate is
+# only negotiated when streaming starts. Resolution comes from the
+# calibration so it never changes while running.
+def needs_reopen(a: CameraParams, b: CameraParams) -> bool:
     if a is None or b is None:
-        return True
-    
-    return a.auto_exposure != b.auto_exposure or a.exposure != b.exposure or a.gain != b.gain or a.target_fps != b.target_fps
+        return a is not b
+    return a.target_fps != b.target_fps
+
+# Raw MJPEG data comes out of OpenCV as a single row of bytes
+def is_encoded(data: numpy.ndarray) -> bool:
+    return data.ndim == 1 or (data.ndim == 2 and data.shape[0] == 1)
+
+GRAY_DECODE_FLAGS = {
+    1: cv2.IMREAD_GRAYSCALE,
+    2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+    4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+    8: cv2.IMREAD_REDUCED_GRAYSCALE_8
+}
+COLOR_DECODE_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8
+}
+
+# Decodes MJPEG data straight into the image the detector wants. The JPEG
+# decoder can skip the chroma planes and the finer DCT coefficients, so
+# grayscale and reduced decodes are much cheaper than a full BGR decode.
+def decode_frame(data: numpy.ndarray, conf: config.DecodeConfig, pool: frame_pool.FramePool) -> cv2.Mat:
+    if is_encoded(data):
+        # imdecode can't decode into an existing buffer from Python, so
+        # these don't come from the pool
+        flags = GRAY_DECODE_FLAGS if conf.grayscale else COLOR_DECODE_FLAGS
+        return cv2.imdecode(data, flags[conf.scale])
+
+    # Source already decoded it, convert to match
+    image = data
+    if conf.grayscale and image.ndim == 3:
+        gray = pool.acquire(image.shape[:2])
+        cv2.cvtColor(image, cv2.COLOR_BGR2GRAY, dst=gray)
+        pool.release(image)
+        image = gray
+    if conf.scale != 1:
+        size = (image.shape[1] // conf.scale, image.shape[0] // conf.scale)
+        scaled = pool.acquire((size[1], size[0]) + image.shape[2:])
+        cv2.resize(image, size, dst=scaled, interpolation=cv2.INTER_AREA)
+        pool.release(image)
+        image = scaled
+    return image
+
+# Reads the next frame from an OpenCV capture into a buffer from the pool
+def read_pooled(capture: cv2.VideoCapture, pool: frame_pool.FramePool, shape: tuple) -> tuple[bool, numpy.ndarray]:
+    buf = pool.acquire(shape)
+    ret, image = capture.read(image=buf)
+    if image is not buf:
+        # Frame didn't fit so OpenCV allocated a new one
+        pool.release(buf)
+    return (ret, image)
+
+# Where frames come from. read() gives either a decoded image or the still
+# compressed MJPEG bytes (see is_encoded), along with the capture timestamp
+class CaptureSource:
+    # Live sources need the camera params from NT before they can be opened
+    live: bool = False
+
+    def open(self, params: CameraParams):
+        pass
+
+    # Applies params that don't need a reopen, see needs_reopen
+    def apply(self, params: CameraParams):
+        pass
+
+    # Decoded images should come from the pool where possible
+    def read(self, pool: frame_pool.FramePool) -> tuple[bool, numpy.ndarray, float]:
+        raise NotImplementedError
+
+    def release(self):
+        pass
+
+class V4L2Source(CaptureSource):
+    live = True
+
+    # With raw set, frames are read as the MJPEG bytes the camera sent
+    def __init__(self, settings: config.CameraSettings, raw: bool):
+        self.settings = settings
+        self.raw = raw
+        self.capture = None
+        resolution = settings.calibration.resolution
+        self.frame_shape = (int(resolution[1]), int(resolution[0]), 3)
+
+    def open(self, params: CameraParams):
+        resolution = self.settings.calibration.resolution
+        self.capture = cv2.VideoCapture(self.settings.id, cv2.CAP_V4L2)
+
+        self.capture.set(cv2.CAP_PROP_FRAME_WIDTH, resolution[0])
+        self.capture.set(cv2.CAP_PROP_FRAME_HEIGHT, resolution[1])
+        self.capture.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc('M', 'J', 'P', 'G'))
+        if self.raw:
+            self.capture.set(cv2.CAP_PROP_CONVERT_RGB, 0)
+
+        self.capture.set(cv2.CAP_PROP_FPS, params.target_fps)
+        self.apply(params)
+
+    def apply(self, params: CameraParams):
+        self.capture.set(cv2.CAP_PROP_AUTO_EXPOSURE, 3 if params.auto_exposure else 1)
+        self.capture.set(cv2.CAP_PROP_EXPOSURE, params.exposure)
+        self.capture.set(cv2.CAP_PROP_GAIN, params.gain)
+
+    def read(self, pool: frame_pool.FramePool) -> tuple[bool, numpy.ndarray, float]:
+        if self.raw:
+            ret, data = self.capture.read()
+        else:
+            ret, data = read_pooled(self.capture, pool, self.frame_shape)
+        if not ret:
+            return (False, None, None)
+        if not self.raw:
+            self.frame_shape = data.shape
+
+        # V4L2 frame timestamp for time at which frame was captured
+        # It binds to CLOCK_MONOTONIC (= time.monotonic())
+        return (True, data, self.capture.get(cv2.CAP_PROP_POS_MSEC) / 1000.0)
+
+    def release(self):
+        if self.capture is not None:
+            self.capture.release()
+            self.capture = None
+
+# Keeps the spacing between the recorded timestamps, but shifted so playback
+# starts now. In realtime mode it also waits for each frame's turn.
+class PlaybackClock:
+    def __init__(self, realtime: bool):
+        self.realtime = realtime
+        self.offset = None
+
+    def restart(self):
+        self.offset = None
+
+    def frame_time(self, recorded: float) -> float:
+        if self.offset is None:
+            self.offset = time.monotonic() - recorded
+        if not self.realtime:
+            return time.monotonic()
+
+        timestamp = recorded + self.offset
+        delay = timestamp - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        return timestamp
+
+# Plays back a directory written by FrameRecorder
+class FrameDirectorySource(CaptureSource):
+    def __init__(self, conf: config.SourceConfig):
+        self.conf = conf
+        self.clock = PlaybackClock(conf.realtime)
+        self.files = []
+        self.index = 0
+
+    def open(self, params: CameraParams):
+        self.files = []
+        for file_name in sorted(os.listdir(self.conf.path)):
+            if not file_name.endswith(".jpg"):
+                continue
+            # Recorded as <sequence>_<timestamp>.jpg
+            recorded = float(file_name[:-4].split("_")[1])
+            self.files.append((os.path.join(self.conf.path, file_name), recorded))
+        self.index = 0
+        self.clock.restart()
+        print(self.conf.path, "has", len(self.files), "frames")
+
+    def read(self, pool: frame_pool.FramePool) -> tuple[bool, numpy.ndarray, float]:
+        if self.index >= len(self.files):
+            if not self.conf.loop or len(self.files) == 0:
+                return (False, None, None)
+            self.index = 0
+            self.clock.restart()
+
+        path, recorded = self.files[self.index]
+        self.index += 1
+        data = numpy.fromfile(path, dtype=numpy.uint8)
+        return (True, data, self.clock.frame_time(recorded))
+
+class VideoFileSource(CaptureSource):
+    def __init__(self, conf: config.SourceConfig):
+        self.conf = conf
+        self.clock = PlaybackClock(conf.realtime)
+        self.capture = None
+        self.frame_shape = None
+
+    def open(self, params: CameraParams):
+        self.capture = cv2.VideoCapture(self.conf.path)
+        self.clock.restart()
+        width = int(self.capture.get(cv2.CAP_PROP_FRAME_WIDTH))
+        height = int(self.capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        self.frame_shape = (height, width, 3)
+
+    def read(self, pool: frame_pool.FramePool) -> tuple[bool, numpy.ndarray, float]:
+        ret, image = read_pooled(self.capture, pool, self.frame_shape)
+        if not ret and self.conf.loop:
+            self.capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            self.clock.restart()
+            ret, image = read_pooled(self.capture, pool, self.frame_shape)
+        if not ret:
+            return (False, None, None)
+        self.frame_shape = image.shape
+
+        # Position in the file is the time the frame was recorded
+        recorded = self.capture.get(cv2.CAP_PROP_POS_MSEC) / 1000.0
+        return (True, image, self.clock.frame_time(recorded))
+
+    def release(self):
+        if self.capture is not None:
+            self.capture.release()
+            self.capture = None
+
+def create_source(settings: config.CameraSettings, raw: bool) -> CaptureSource:
+    source_type = settings.source.type
+    if source_type == "v4l2":
+        return V4L2Source(settings, raw)
+    elif source_type == "frames":
+        return FrameDirectorySource(settings.source)
+    elif source_type == "video":
+        return VideoFileSource(settings.source)
+    else:
+        raise ValueError("Unknown capture source type: " + source_type)
+
+def write_thread(out_dir: str, write_queue: queue.Queue):
+    while True:
+        seq, timestamp, data = write_queue.get()
+        data.tofile(f"{out_dir}{seq:08d}_{timestamp:.6f}.jpg")
+
+# Saves the compressed frames exactly as the camera sent them, in the format
+# FrameDirectorySource plays back
+class FrameRecorder:
+    def __init__(self, conf: config.RecordingConfig, camera: str):
+        uid = random.randint(0, 1000000000)
+        self.out_dir = f"{conf.output_dir}{camera}_{uid}/"
+        os.makedirs(self.out_dir, exist_ok=True)
+        print(camera, "recording frames to", self.out_dir)
+
+        self.seq = 0
+        self.dropped = 0
+        # Bounded so a slow disk can't eat all the memory
+        self.write_queue = queue.Queue(maxsize=100)
+        thr = threading.Thread(target=write_thread, args=(self.out_dir, self.write_queue))
+        thr.daemon = True
+        thr.start()
+
+    def write(self, data: numpy.ndarray, timestamp: float):
+        try:
+            self.write_queue.put_nowait((self.seq, timestamp, data))
+        except queue.Full:
+            self.dropped += 1
+        self.seq += 1
 
 class CameraInputThread(threading.Thread):
     name: str
-    capture: cv2.VideoCapture
-    frame_queue: queue.PriorityQueue[CameraFrame]
+    source: CaptureSource
+    frame_queue: "frame_buffer.FrameBuffer"
     fps: int
     count: int
     prev_time: float
     running: bool
 
     # nt is CameraNetworkTablesIO
-    def __init__(self, settings: config.CameraSettings, frame_debug_conf: config.FrameDebugConfig, frame_queue: queue.PriorityQueue[CameraFrame], nt):
+    # frame_queue is frame_buffer.FrameBuffer
+    def __init__(self, settings: config.CameraSettings, frame_debug_conf: config.FrameDebugConfig, recording_conf: config.RecordingConfig, frame_queue, pool: frame_pool.FramePool, nt):
         threading.Thread.__init__(self)
         self.settings = settings
         self.nt = nt
+        self.pool = pool
         
         self.frame_queue = frame_queue
         self.fps = 0
         self.count = 0
+        self.seq = 0
         self.prev_time = time.time()
         self.calibration = settings.calibration
-        self.capture = None
         self.current_config = None
         self.running = True
         self.frame_debug_conf = frame_debug_conf
         self.has_printed_error = False
 
-    def next_frame(self) -> tuple[bool, cv2.Mat, float]:
-        config = self.nt.get_config_params()
-        if is_config_different(self.current_config, config) and self.capture != None:
-            print(self.settings.name, "stopping capture")
-            self.capture.release()
-            self.capture = None
+        # Recording and grayscale/reduced decoding need the frames before OpenCV decodes them
+        self.recorder = FrameRecorder(recording_conf, settings.name) if recording_conf.enabled else None
+        full_decode = not settings.decode.grayscale and settings.decode.scale == 1
+        self.source = create_source(settings, raw=self.recorder is not None or not full_decode)
+        self.source_open = False
+        self.has_printed_record_error = False
+        self.image_pooled = False
+        # When the capture was closed to be reopened with new params
+        self.reopen_start = None
+
+    # Returns the decoded image, and the MJPEG data it came from if there was any
+    def next_frame(self) -> tuple[bool, cv2.Mat, numpy.ndarray, float]:
+        # Only live cameras are configured from NT. This is just the params
+        # NT last received, they're only compared when they've changed.
+        config = self.nt.get_config_params() if self.source.live else None
+        if self.source_open and config is not self.current_config and config != self.current_config:
+            if needs_reopen(self.current_config, config):
+                print(self.settings.name, "stopping capture")
+                self.reopen_start = time.monotonic()
+                self.source.release()
+                self.source_open = False
+            else:
+                self.source.apply(config)
+                self.current_config = config
+                print(self.settings.name, "applied config live:", config)
         
         capture_is_new = False
-        if self.capture is None and config != None:
+        if not self.source_open and (config != None or not self.source.live):
             print(self.settings.name, "opening capture")
-            self.capture = cv2.VideoCapture(self.settings.id, cv2.CAP_V4L2)
-        
-            self.capture.set(cv2.CAP_PROP_FRAME_WIDTH, self.calibration.resolution[0])
-            self.capture.set(cv2.CAP_PROP_FRAME_HEIGHT, self.calibration.resolution[1])
-            self.capture.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc('M', 'J', 'P', 'G'))
-            
-            self.capture.set(cv2.CAP_PROP_FPS, config.target_fps)
-            self.capture.set(cv2.CAP_PROP_AUTO_EXPOSURE, 3 if config.auto_exposure else 1)
-            self.capture.set(cv2.CAP_PROP_EXPOSURE, config.exposure)
-            self.capture.set(cv2.CAP_PROP_GAIN, config.gain)
+            self.source.open(config)
+            self.source_open = True
 
             self.current_config = config
-            print(self.settings.name, "applied config:", config)
+            if config != None:
+                print(self.settings.name, "applied config:", config)
             capture_is_new = True
 
-        if self.capture is None:
+        if not self.source_open:
             self.nt.publish_alive(False)
-            return (False, None, None)
+            return (False, None, None, None)
         else:
-            ret, image = self.capture.read()
-            if not ret:
+            ret, data, timestamp = self.source.read(self.pool)
+            image = None
+            if ret:
+                if self.recorder is not None:
+                    if is_encoded(data):
+                        self.recorder.write(data, timestamp)
+                    elif not self.has_printed_record_error:
+                        print(self.settings.name, "source gives decoded frames, not recording")
+                        self.has_printed_record_error = True
+                image = decode_frame(data, self.settings.decode, self.pool)
+                # Images decoded from MJPEG data are not pool buffers
+                self.image_pooled = not is_encoded(data)
+
+            if image is None:
                 if not self.has_printed_error:
                     print(self.settings.name, "did not receive image")
                     self.has_printed_error = True
                 self.nt.publish_alive(False)
-                return (False, None, None)
-            
-            # V4L2 frame timestamp for time at which frame was captured
-            # It binds to CLOCK_MONOTONIC (= time.monotonic())
-            timestamp = self.capture.get(cv2.CAP_PROP_POS_MSEC) / 1000.0
+                return (False, None, None, None)
 
             if capture_is_new and self.frame_debug_conf.enabled:
                 out_dir = self.frame_debug_conf.output_dir
                 uid = random.randint(0, 1000000000)
                 filename = f"{out_dir}first_frame_{uid}.png"
-                cv2.imwrite(filename, image)
+                # Always save the full color frame, whatever the detector gets
+                cv2.imwrite(filename, cv2.imdecode(data, cv2.IMREAD_COLOR) if is_encoded(data) else data)
                 print(self.settings.name, "saved frame to", filename)
                 self.nt.publish_first_frame_filename(filename)
 
+            if self.reopen_start is not None:
+                self.nt.publish_reopen_latency(time.monotonic() - self.reopen_start)
+                self.reopen_start = None
+
             self.nt.publish_alive(True)
             self.has_printed_error = False
-            return (True, image, timestamp)
+            return (True, image, data if is_encoded(data) else None, timestamp)
 
     def run(self):
         print(self.settings.name, "starting capture thread")
         while self.running:
-            retval, image, timestamp = self.next_frame()
+            retval, image, encoded, timestamp = self.next_frame()
             if retval:
                 self.count += 1
                 # Use while in case a frame took over 1 second
@@ -120,17 +429,23 @@ class CameraInputThread(threading.Thread):
                     self.fps = self.count
                     self.count = 0
                     self.prev_time += 1
+                    self.nt.publish_dropped_frames(self.frame_queue.get_dropped(self.settings.name))
+                    self.nt.publish_pool_stats(*self.pool.get_stats())
 
                 self.frame_queue.put(CameraFrame(
                     timestamp=timestamp,
                     camera=self.settings.name,
                     calibration=self.calibration,
                     image=image,
-                    rate=self.fps
+                    rate=self.fps,
+                    scale=self.settings.decode.scale,
+                    pool=self.pool if self.image_pooled else None,
+                    seq=self.seq,
+                    encoded=encoded
                 ))
+                self.seq += 1
             else:
                 time.sleep(1)
 
-        if self.capture is not None:
-            self.capture.release()
+        self.source.release()
         print(self.settings.name, "stopped capture thread")
@@ -2,6 +2,7 @@ import json
 import math
 import numpy
 import numpy.typing
+import threading
 
 from dataclasses import dataclass
 from wpimath.geometry import *
@@ -12,26 +13,103 @@ class CalibrationInfo:
     matrix: numpy.typing.NDArray[numpy.float64]
     distortion_coeffs: numpy.typing.NDArray[numpy.float64]
 
+@dataclass
+class SourceConfig:
+    type: str # "v4l2", "frames" or "video"
+    path: str
+    realtime: bool
+    loop: bool
+
+@dataclass
+class DecodeConfig:
+    grayscale: bool
+    scale: int # Image is decoded at 1/scale resolution, one of 1, 2, 4, 8
+
+@dataclass
+class DetectorConfig:
+    # Search only around where tags were in previous frames
+    tracking: bool
+    # Tracking regions grow by this fraction of the tag's size on every side
+    roi_padding: float
+    # Search the whole frame at least once every this many frames
+    full_scan_interval: int
+    # Full frame searches run on the image resized by this, then the corners
+    # are refined on the full image within refine_window pixels
+    scale: float
+    refine_window: int
+    # Name of the DetectorParameters profile and the parameters it resolved to
+    profile: str
+    params: dict[str, object]
+
+@dataclass
+class SolverConfig:
+    # Start from the previous frame's pose when the same tags are seen again
+    # within max_frame_gap seconds. Multiple tags refine it instead of solving
+    # from scratch, a single tag uses it to pick between the two IPPE solutions
+    # so only one is sent.
+    warm_start: bool
+    max_frame_gap: float
+    # Poses further than this from the seed, in reprojection error (pixels)
+    # or translation (meters), are solved again from scratch
+    max_reprojection_error: float
+    max_jump: float
+    # Single tag solves only seed the next frame when the best IPPE solution's
+    # error is at most this fraction of the other's
+    max_ambiguity: float
+
 @dataclass
 class CameraSettings:
     id: int
     name: str
     calibration: CalibrationInfo
+    source: SourceConfig
+    decode: DecodeConfig
+    detector: DetectorConfig
+    solver: SolverConfig
 
-@dataclass
+# One version of the field layout. Snapshots are never changed once made, a
+# new layout is swapped in as a new snapshot, see SharedEnvironment.
+@dataclass(frozen=True)
 class TagEnvironment:
     tag_size: float
     tags: dict[int, Pose3d]
+    # Higher for every newer snapshot
+    version: int = 0
 
     def get_tag_pose(self, id: int) -> Pose3d:
         if id not in self.tags:
             return None
         return self.tags[id]
     
+# The current TagEnvironment, shared by everything that reads it. Swapping
+# the reference is atomic, so readers grab the snapshot once per frame and
+# see the same layout for all of it without locking.
+class SharedEnvironment:
+    env: TagEnvironment
+
+    def __init__(self, env: TagEnvironment):
+        self.env = env
+        self.lock = threading.Lock()
+
+    def get(self) -> TagEnvironment:
+        return self.env
+
+    # Swaps in a snapshot of the new layout with the next version
+    def update(self, tag_size: float, tags: dict[int, Pose3d]) -> TagEnvironment:
+        with self.lock:
+            env = TagEnvironment(tag_size, dict(tags), self.env.version + 1)
+            self.env = env
+        return env
+
 @dataclass
 class NetworkTablesConfig:
     server_ip: str
     identity: str
+    # Layout of the poses topic, 1 or 2, see pose_format
+    output_format: int
+    # Whether version 2 includes tag corners, only AdvantageScope needs them.
+    # Version 1 always has them.
+    send_corners: bool
 
 @dataclass
 class FrameDebugConfig:
@@ -47,15 +125,65 @@ class LoggingConfig:
     enabled: bool
     output_dir: str
 
+@dataclass
+class RecordingConfig:
+    enabled: bool
+    output_dir: str
+
+@dataclass
+class LoadControlConfig:
+    enabled: bool
+    # Seconds from capture to publishing to stay under, see load_control
+    target_latency: float
+    # Camera whose frames are never skipped, or None
+    priority_camera: str
+    min_workers: int
+    max_workers: int
+    # Most frames a camera can be slowed to processing one of
+    max_frame_skip: int
+
 @dataclass
 class TagTrackerConfig:
     networktables: NetworkTablesConfig
     tag_family: str
     process_threads: int
+    process_backend: str # "thread" or "process"
+    # Seconds a result waits for older frames of its camera, see reorder
+    reorder_deadline: float
+    detector_profiles: dict[str, dict[str, object]]
     cameras: list[CameraSettings]
     frame_debug: FrameDebugConfig
     stream: StreamConfig
     logging: LoggingConfig
+    recording: RecordingConfig
+    load_control: LoadControlConfig
+    environment: str
+
+# Profiles every config can use without defining them in "detector-profiles".
+# Keys are the DetectorParameters attributes in kebab case, anything left out
+# keeps the OpenCV default.
+DETECTOR_PROFILES = {
+    "default": {},
+    # Fewer threshold passes and no tiny tags, for cameras that only need close tags
+    "fast": {
+        "adaptive-thresh-win-size-min": 5,
+        "adaptive-thresh-win-size-max": 15,
+        "adaptive-thresh-win-size-step": 10,
+        "min-marker-perimeter-rate": 0.05,
+        "corner-refinement-method": "none"
+    },
+    # Extra threshold passes and subpixel corners, for long range
+    "accurate": {
+        "adaptive-thresh-win-size-min": 3,
+        "adaptive-thresh-win-size-max": 33,
+        "adaptive-thresh-win-size-step": 5,
+        "min-marker-perimeter-rate": 0.01,
+        "corner-refinement-method": "subpix",
+        "corner-refinement-win-size": 5,
+        "corner-refinement-max-iterations": 30,
+        "corner-refinement-min-accuracy": 0.01
+    }
+}
 
 def load_calibration(file_name: str) -> CalibrationInfo:
     with open(file_name, 'r') as json_file:
@@ -76,31 +204,116 @@ def load_calibration(file_name: str) -> CalibrationInfo:
         matrix=mtx,
         distortion_coeffs=dist
     )
+
+# Loads a field layout in the same JSON format as environment.json
+def load_environment(file_name: str) -> TagEnvironment:
+    with open(file_name, 'r') as json_file:
+        json_obj = json.load(json_file)
+
+    tags = {}
+    for tag_obj in json_obj["tags"]:
+        tx = tag_obj["pose"]["translation"]
+        q = tag_obj["pose"]["rotation"]["quaternion"]
+        tags[tag_obj["ID"]] = Pose3d(
+            Translation3d(tx["x"], tx["y"], tx["z"]),
+            Rotation3d(Quaternion(q["W"], q["X"], q["Y"], q["Z"]))
+        )
+
+    return TagEnvironment(
+        tag_size=json_obj["tag_size"],
+        tags=tags
+    )
     
 def load_config(file_name: str) -> TagTrackerConfig:
     with open(file_name, 'r') as json_file:
         json_obj = json.load(json_file)
 
     nt_obj = json_obj["networktables"]
+    output_format = nt_obj.get("output-format", 1)
+    if output_format not in (1, 2):
+        raise ValueError("Output format must be 1 or 2, got " + str(output_format))
     frame_debug_obj = json_obj["frame-debug"]
     stream_obj = json_obj["web-stream"]
     logging_obj = json_obj["logging"]
+    recording_obj = json_obj.get("recording", {})
+    load_control_obj = json_obj.get("load-control", {})
+    # Profiles in the config replace built in ones with the same name
+    profiles = dict(DETECTOR_PROFILES)
+    profiles.update(json_obj.get("detector-profiles", {}))
 
     cameras = []
     for camera_obj in json_obj["cameras"]:
+        # Cameras without a source are V4L2 devices
+        source_obj = camera_obj.get("source", {})
+        decode_obj = camera_obj.get("decode", {})
+        detector_obj = camera_obj.get("detector", {})
+        solver_obj = camera_obj.get("solver", {})
+        decode_scale = decode_obj.get("scale", 1)
+        if decode_scale not in (1, 2, 4, 8):
+            raise ValueError("Decode scale must be 1, 2, 4 or 8, got " + str(decode_scale))
+        profile = detector_obj.get("profile", "default")
+        if profile not in profiles:
+            raise ValueError("Unknown detector profile " + profile)
+
         cameras.append(CameraSettings(
             id=camera_obj["id"],
             name=camera_obj["name"],
-            calibration=load_calibration(camera_obj["calibration"])
+            calibration=load_calibration(camera_obj["calibration"]),
+            source=SourceConfig(
+                type=source_obj.get("type", "v4l2"),
+                path=source_obj.get("path"),
+                realtime=source_obj.get("realtime", True),
+                loop=source_obj.get("loop", False)
+            ),
+            decode=DecodeConfig(
+                grayscale=decode_obj.get("grayscale", False),
+                scale=decode_scale
+            ),
+            detector=DetectorConfig(
+                tracking=detector_obj.get("tracking", False),
+                roi_padding=detector_obj.get("roi-padding", 0.75),
+                full_scan_interval=detector_obj.get("full-scan-interval", 10),
+                scale=detector_obj.get("scale", 1.0),
+                refine_window=detector_obj.get("refine-window", 5),
+                profile=profile,
+                params=profiles[profile]
+            ),
+            solver=SolverConfig(
+                warm_start=solver_obj.get("warm-start", False),
+                max_frame_gap=solver_obj.get("max-frame-gap", 0.1),
+                max_reprojection_error=solver_obj.get("max-reprojection-error", 2.0),
+                max_jump=solver_obj.get("max-jump", 0.25),
+                max_ambiguity=solver_obj.get("max-ambiguity", 0.2)
+            )
         ))
 
+    # Without load control the worker count stays at process-threads
+    process_threads = json_obj["process-threads"]
+    load_control = LoadControlConfig(
+        enabled=load_control_obj.get("enabled", False),
+        target_latency=load_control_obj.get("target-latency", 0.1),
+        priority_camera=load_control_obj.get("priority-camera"),
+        min_workers=load_control_obj.get("min-workers", 1),
+        max_workers=load_control_obj.get("max-workers", process_threads),
+        max_frame_skip=load_control_obj.get("max-frame-skip", 4)
+    )
+    if load_control.enabled and not load_control.min_workers <= process_threads <= load_control.max_workers:
+        raise ValueError("process-threads must be between load control min-workers and max-workers")
+    if load_control.priority_camera is not None and load_control.priority_camera not in [camera.name for camera in cameras]:
+        raise ValueError("Unknown priority camera " + load_control.priority_camera)
+
     return TagTrackerConfig(
         networktables=NetworkTablesConfig(
             server_ip=nt_obj["server-ip"],
-            identity=nt_obj["identity"]
+            identity=nt_obj["identity"],
+            output_format=output_format,
+            send_corners=nt_obj.get("send-corners", True)
         ),
         tag_family=json_obj["tag-family"],
-        process_threads=json_obj["process-threads"],
+        process_threads=process_threads,
+        process_backend=json_obj.get("process-backend", "thread"),
+        reorder_deadline=json_obj.get("reorder-deadline", 0.05),
+        detector_profiles=profiles,
         cameras=cameras,
         frame_debug=FrameDebugConfig(
             enabled=frame_debug_obj["enabled"],
@@ -112,5 +325,11 @@ def load_config(file_name: str) -> TagTrackerConfig:
         logging=LoggingConfig(
             enabled=logging_obj["enabled"],
             output_dir=logging_obj["output-dir"]
-        )
+        ),
+        recording=RecordingConfig(
+            enabled=recording_obj.get("enabled", False),
+            output_dir=recording_obj.get("output-dir", "recordings/")
+        ),
+        load_control=load_control,
+        environment=json_obj.get("environment")
     )
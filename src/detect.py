@@ -1,22 +1,200 @@
 import cv2
+import math
 import numpy
 import numpy.typing
+import threading
 from dataclasses import dataclass
 
+import config
+
 @dataclass
 class DetectedTag:
     id: int
     corners: numpy.typing.NDArray[numpy.float64]
 
+# Where a tag was in the last two frames it was seen in, and when
+@dataclass(frozen=True)
+class TrackedTag:
+    corners: numpy.typing.NDArray[numpy.float32]
+    prev_corners: numpy.typing.NDArray[numpy.float32]
+    timestamp: float
+    prev_timestamp: float
+
+# What tracking knows about a camera as of the newest frame detected so far
+@dataclass(frozen=True)
+class TrackingState:
+    tracked: dict[int, TrackedTag]
+    frames_since_full_scan: int
+    timestamp: float
+
+# One per camera, shared by every worker detecting its frames, since each
+# worker only sees some of them. Frames finish out of order, so a state only
+# replaces the current one if it's from a newer frame.
+class CameraTracking:
+    state: TrackingState
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.state = TrackingState({}, 0, -math.inf)
+
+    def get(self) -> TrackingState:
+        return self.state
+
+    def update(self, state: TrackingState):
+        with self.lock:
+            if state.timestamp > self.state.timestamp:
+                self.state = state
+
+CORNER_REFINE_METHODS = {
+    "none": cv2.aruco.CORNER_REFINE_NONE,
+    "subpix": cv2.aruco.CORNER_REFINE_SUBPIX,
+    "contour": cv2.aruco.CORNER_REFINE_CONTOUR,
+    "apriltag": cv2.aruco.CORNER_REFINE_APRILTAG
+}
+
+# Builds DetectorParameters from a profile in config.DETECTOR_PROFILES form,
+# where keys are the parameter names in kebab case
+def create_parameters(profile: dict[str, object]) -> cv2.aruco.DetectorParameters:
+    params = cv2.aruco.DetectorParameters()
+    for key, value in profile.items():
+        words = key.split("-")
+        name = words[0] + "".join(word.capitalize() for word in words[1:])
+        if not hasattr(params, name):
+            raise ValueError("Unknown detector parameter " + key)
+        if name == "cornerRefinementMethod":
+            if value not in CORNER_REFINE_METHODS:
+                raise ValueError("Unknown corner refinement method " + str(value))
+            value = CORNER_REFINE_METHODS[value]
+        setattr(params, name, value)
+    return params
+
+# Merges overlapping (x0, y0, x1, y1) rectangles so no area is searched twice
+def merge_regions(regions: list[list[int]]) -> list[list[int]]:
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(regions)):
+            for j in range(i + 1, len(regions)):
+                a = regions[i]
+                b = regions[j]
+                if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                    regions[i] = [min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])]
+                    del regions[j]
+                    merged = True
+                    break
+            if merged:
+                break
+    return regions
+
 class TagDetector:
-    def __init__(self, aruco_dict: int):
+    # conf is for the camera this detector is used for, and tracking is that
+    # camera's, shared with the other workers' detectors for it
+    def __init__(self, aruco_dict: int, conf: config.DetectorConfig = None, tracking: CameraTracking = None):
         dict = cv2.aruco.getPredefinedDictionary(aruco_dict)
-        params = cv2.aruco.DetectorParameters()
+        params = create_parameters({} if conf is None else conf.params)
         self.detector = cv2.aruco.ArucoDetector(dict, params)
 
-    def detect(self, image) -> list[DetectedTag]:
+        self.conf = conf
+        self.tracking = tracking if tracking is not None else CameraTracking()
+        # Scale the last frame was searched at
+        self.last_scale = 1.0
+
+    def detect_region(self, image, x: int, y: int) -> list[DetectedTag]:
         corners, ids, _ = self.detector.detectMarkers(image)
         # corners, ids, _ = cv2.aruco.detectMarkers(image, self.dict, parameters=self.params)
         if len(corners) == 0:
             return []
+        if x != 0 or y != 0:
+            # Back to full frame coordinates
+            for corner in corners:
+                corner += (x, y)
         return [DetectedTag(id[0], corner) for id, corner in zip(ids, corners)]
+
+    # Regions around where each tracked tag is expected to be in the frame
+    # captured at timestamp, assuming it keeps moving like it did between the
+    # last two frames it was seen in
+    def predict_regions(self, state: TrackingState, timestamp: float, width: int, height: int) -> list[list[int]]:
+        regions = []
+        for tag in state.tracked.values():
+            predicted = tag.corners
+            if tag.prev_corners is not None:
+                # Other workers' frames can be in between, or this frame can
+                # even be older than the state
+                steps = (timestamp - tag.timestamp) / max(tag.timestamp - tag.prev_timestamp, 1e-6)
+                predicted = tag.corners + (tag.corners - tag.prev_corners) * steps
+            points = numpy.concatenate((tag.corners, predicted))
+            x0, y0 = points.min(axis=0)
+            x1, y1 = points.max(axis=0)
+
+            pad = self.conf.roi_padding * max(x1 - x0, y1 - y0)
+            regions.append([
+                max(0, int(x0 - pad)), max(0, int(y0 - pad)),
+                min(width, int(x1 + pad) + 1), min(height, int(y1 + pad) + 1)
+            ])
+        return merge_regions(regions)
+
+    # Searches a downscaled copy of the image, which is much faster but loses
+    # some range, then moves the corners back to where they are in the full
+    # resolution image
+    def detect_scaled(self, image, scale: float) -> list[DetectedTag]:
+        small = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        detections = self.detect_region(small, 0, 0)
+        if len(detections) == 0:
+            return detections
+
+        gray = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        corners = numpy.concatenate([tag.corners[0] for tag in detections]) / scale
+        window = self.conf.refine_window
+        criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 10, 0.01)
+        cv2.cornerSubPix(gray, corners, (window, window), (-1, -1), criteria)
+
+        for i, tag in enumerate(detections):
+            tag.corners = corners[i * 4:i * 4 + 4].reshape(1, 4, 2)
+        return detections
+
+    def detect_full(self, image) -> list[DetectedTag]:
+        if self.conf is not None and self.conf.scale < 1.0:
+            self.last_scale = self.conf.scale
+            return self.detect_scaled(image, self.conf.scale)
+        self.last_scale = 1.0
+        return self.detect_region(image, 0, 0)
+
+    def detect_tracked(self, image, state: TrackingState, timestamp: float) -> list[DetectedTag]:
+        detections = {}
+        for x0, y0, x1, y1 in self.predict_regions(state, timestamp, image.shape[1], image.shape[0]):
+            if x1 <= x0 or y1 <= y0:
+                continue
+            for tag in self.detect_region(image[y0:y1, x0:x1], x0, y0):
+                detections[tag.id] = tag
+        return list(detections.values())
+
+    def update_tracking(self, state: TrackingState, detections: list[DetectedTag], timestamp: float, frames_since_full_scan: int):
+        tracked = {}
+        for tag in detections:
+            prev = state.tracked.get(tag.id)
+            # Copy since the caller may rescale the corners in place
+            tracked[tag.id] = TrackedTag(
+                tag.corners[0].copy(), None if prev is None else prev.corners,
+                timestamp, None if prev is None else prev.timestamp)
+        self.tracking.update(TrackingState(tracked, frames_since_full_scan, timestamp))
+
+    # timestamp is the frame's capture time, tracking uses it to predict where
+    # tags moved since the frames it knows about
+    def detect(self, image, timestamp: float = 0) -> list[DetectedTag]:
+        if self.conf is None or not self.conf.tracking:
+            return self.detect_full(image)
+
+        # Only search around the known tags, unless it's time for a full scan
+        # to pick up new tags or tracking found nothing
+        state = self.tracking.get()
+        if len(state.tracked) != 0 and state.frames_since_full_scan < self.conf.full_scan_interval:
+            detections = self.detect_tracked(image, state, timestamp)
+            if len(detections) != 0:
+                # Tracking regions are small enough to search at full resolution
+                self.last_scale = 1.0
+                self.update_tracking(state, detections, timestamp, state.frames_since_full_scan + 1)
+                return detections
+
+        detections = self.detect_full(image)
+        self.update_tracking(state, detections, timestamp, 0)
+        return detections
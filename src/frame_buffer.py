@@ -0,0 +1,102 @@
+import queue
+import threading
+
+import capture
+
+# Hands frames from the camera input threads to the tag process threads.
+# Every camera holds only its newest frame, so if processing falls behind the
+# older frames of that camera are dropped instead of building up a backlog.
+class FrameBuffer:
+    # None while a camera has no frame waiting
+    frames: dict[str, capture.CameraFrame]
+    dropped: dict[str, int]
+    # Sequence numbers of frames handed out whose results haven't been
+    # published yet, so the reorder stage knows which results are still coming
+    processing: dict[str, set[int]]
+    # Only one of every skip[camera] frames is kept, see set_skip
+    skip: dict[str, int]
+    skipped: dict[str, int]
+
+    def __init__(self):
+        self.frames = {}
+        self.dropped = {}
+        self.processing = {}
+        self.skip = {}
+        self.skipped = {}
+        self.cond = threading.Condition()
+
+    def put(self, frame: capture.CameraFrame):
+        with self.cond:
+            if frame.camera not in self.frames:
+                self.frames[frame.camera] = None
+                self.dropped[frame.camera] = 0
+                self.processing[frame.camera] = set()
+                self.skipped[frame.camera] = 0
+
+            skip = self.skip.get(frame.camera, 1)
+            if skip > 1 and frame.seq % skip != 0:
+                frame.release()
+                self.skipped[frame.camera] += 1
+                return
+
+            # Replaces the frame no worker got to in time
+            stale = self.frames[frame.camera]
+            if stale is not None:
+                stale.release()
+                self.dropped[frame.camera] += 1
+
+            self.frames[frame.camera] = frame
+            self.cond.notify()
+
+    def _pop_next(self) -> capture.CameraFrame:
+        # Take from the camera that has been waiting the longest so one fast
+        # camera can't starve the others
+        oldest = None
+        for frame in self.frames.values():
+            if frame is not None and (oldest is None or frame.timestamp < oldest.timestamp):
+                oldest = frame
+        if oldest is None:
+            return None
+        self.frames[oldest.camera] = None
+        self.processing[oldest.camera].add(oldest.seq)
+        return oldest
+
+    # Raises queue.Empty if no frame arrives within timeout, like queue.Queue
+    def get(self, timeout: float = None) -> capture.CameraFrame:
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.qsize() != 0, timeout):
+                raise queue.Empty
+            return self._pop_next()
+
+    def qsize(self) -> int:
+        with self.cond:
+            return sum(1 for frame in self.frames.values() if frame is not None)
+
+    def get_dropped(self, camera: str) -> int:
+        return self.dropped.get(camera, 0)
+
+    # Lowers the rate a camera's frames are processed at when there are more
+    # frames than the workers can keep up with. 1 keeps every frame.
+    def set_skip(self, camera: str, skip: int):
+        with self.cond:
+            self.skip[camera] = max(1, skip)
+
+    def get_skipped(self, camera: str) -> int:
+        return self.skipped.get(camera, 0)
+
+    # Whether a frame from camera older than seq is still being processed
+    def is_processing_before(self, camera: str, seq: int) -> bool:
+        with self.cond:
+            return any(s < seq for s in self.processing.get(camera, ()))
+
+    # Called once a frame's result has arrived
+    def finish(self, frame: capture.CameraFrame):
+        with self.cond:
+            self.processing.get(frame.camera, set()).discard(frame.seq)
+
+    # Results up to seq won't be published anymore, so stop waiting for them
+    def forget_before(self, camera: str, seq: int):
+        with self.cond:
+            processing = self.processing.get(camera)
+            if processing:
+                processing.difference_update([s for s in processing if s < seq])
@@ -0,0 +1,36 @@
+import numpy
+import threading
+
+# Recycles image buffers for one camera so every frame doesn't need a fresh
+# multi-megabyte allocation. Buffers are handed out by acquire() and come back
+# through release() once everything using the frame is done with it.
+class FramePool:
+    max_size: int
+    free: list[numpy.ndarray]
+    hits: int
+    misses: int
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.free = []
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def acquire(self, shape: tuple, dtype=numpy.uint8) -> numpy.ndarray:
+        with self.lock:
+            for i, buf in enumerate(self.free):
+                if buf.shape == shape and buf.dtype == dtype:
+                    self.hits += 1
+                    return self.free.pop(i)
+            self.misses += 1
+        return numpy.empty(shape, dtype)
+
+    def release(self, buf: numpy.ndarray):
+        with self.lock:
+            # Anything past max_size is left for the garbage collector
+            if len(self.free) < self.max_size:
+                self.free.append(buf)
+
+    def get_stats(self) -> tuple[int, int]:
+        return (self.hits, self.misses)
@@ -0,0 +1,114 @@
+# Keeps capture to publish latency under a target when the cameras send more
+# frames than the workers can keep up with. Once an interval it looks at the
+# results published since the last one:
+#   Over target, with frames spending longer queued than being processed: add
+#   a worker, up to max-workers. If the last worker added didn't bring the
+#   latency down (more threads than cores, or fighting over the GIL), take it
+#   back and stop adding.
+#   Over target otherwise: process fewer frames of every camera but the
+#   priority one, by skipping frames before they're queued.
+#   Well under target for a few intervals: undo one step, skipping first.
+# The decisions are published under /TagTracker/LoadControl.
+import numpy
+
+import config
+import frame_buffer
+import nt_io
+import process
+
+INTERVAL = 1.0
+# Latency under target * this counts as having room to spare
+RELAX_FRACTION = 0.5
+# Intervals in a row with room to spare before undoing a step
+RELAX_INTERVALS = 3
+# A new worker has to bring latency down to this fraction to count as helping
+GROW_GAIN = 0.9
+
+class LoadController:
+    conf: config.LoadControlConfig
+    worker_count: int
+    # Fewer than max_workers once adding a worker didn't help
+    worker_ceiling: int
+    # Every shed camera keeps one of this many frames
+    skip: int
+
+    # workers is a process.TagThreadPool or process_pool.ProcessWorkerPool
+    def __init__(self, conf: config.LoadControlConfig, cameras: list[str], frame_queue: frame_buffer.FrameBuffer, workers, nt: nt_io.NetworkTablesIO, now: float):
+        self.conf = conf
+        self.frame_queue = frame_queue
+        self.workers = workers
+        self.nt = nt
+        self.cameras = cameras
+        self.shed_cameras = [camera for camera in cameras if camera != conf.priority_camera]
+        self.worker_count = workers.worker_count
+        self.worker_ceiling = conf.max_workers
+        self.skip = 1
+        self.latencies = []
+        self.queue_times = []
+        self.process_times = []
+        # Latency before the last worker was added, until the next update
+        self.grew_from = None
+        self.relaxed_intervals = 0
+        self.next_update = now + INTERVAL
+
+    def observe(self, result: process.FrameResult, now: float):
+        self.latencies.append(now - result.frame.timestamp)
+        # Measured at the worker, so time held for reordering doesn't count
+        # as queued and make it look like another worker would help
+        self.queue_times.append(result.timings.queued)
+        self.process_times.append(result.timings.detect + result.timings.solve)
+
+    def set_worker_count(self, count: int):
+        self.worker_count = count
+        self.workers.set_worker_count(count)
+
+    def set_skip(self, skip: int):
+        self.skip = skip
+        for camera in self.shed_cameras:
+            self.frame_queue.set_skip(camera, skip)
+
+    def update(self, now: float):
+        if now < self.next_update:
+            return
+        self.next_update = now + INTERVAL
+        if len(self.latencies) == 0:
+            return
+
+        latency = numpy.percentile(self.latencies, 90)
+        processing = numpy.mean(self.process_times)
+        queued = numpy.mean(self.queue_times)
+        self.latencies.clear()
+        self.queue_times.clear()
+        self.process_times.clear()
+
+        grew_from = self.grew_from
+        self.grew_from = None
+        conf = self.conf
+        if latency > conf.target_latency:
+            self.relaxed_intervals = 0
+            if grew_from is not None and latency > grew_from * GROW_GAIN:
+                self.worker_ceiling = self.worker_count - 1
+                self.set_worker_count(self.worker_count - 1)
+            elif queued > processing and self.worker_count < self.worker_ceiling:
+                self.grew_from = latency
+                self.set_worker_count(self.worker_count + 1)
+            elif self.skip < conf.max_frame_skip and len(self.shed_cameras) != 0:
+                self.set_skip(self.skip + 1)
+        elif latency < conf.target_latency * RELAX_FRACTION:
+            self.relaxed_intervals += 1
+            if self.relaxed_intervals >= RELAX_INTERVALS:
+                self.relaxed_intervals = 0
+                # Worth trying more workers again next time it's overloaded
+                self.worker_ceiling = conf.max_workers
+                if self.skip > 1:
+                    self.set_skip(self.skip - 1)
+                elif queued < processing and self.worker_count > conf.min_workers:
+                    self.set_worker_count(self.worker_count - 1)
+        else:
+            self.relaxed_intervals = 0
+
+        self.nt.publish_load_control(self.worker_count, latency, queued, processing)
+        for camera in self.cameras:
+            self.nt.get_camera_io(camera).publish_frame_skip(
+                1 if camera == conf.priority_camera else self.skip,
+                self.frame_queue.get_skipped(camera))
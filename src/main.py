@@ -1,7 +1,10 @@
 # Data flow:
-# Camera input threads put frames into frame queue
+# Camera input threads put frames into frame queue (bounded per camera, oldest frames are dropped)
 # Tag process threads take frames from frame queue, find tags, estimate pose, put results into result queue
-# Main thread reads result queue, sends to NT, logs, shows GUI
+#   (or with the process backend, worker processes do it with frames passed through shared memory)
+# Main thread reads result queue, puts each camera's results back in capture
+#   order (see reorder), sends to NT, then hands results to the stream, logger
+#   and GUI threads (see output_dispatch)
 
 import cv2
 import math
@@ -12,9 +15,16 @@ from argparse import ArgumentParser
 
 import config
 import capture
+import frame_buffer
+import frame_pool
+import load_control
 import nt_io
+import output_dispatch
 import output_logger
 import process
+import process_pool
+import reorder
+import replay
 import web_stream
 
 def main():
@@ -24,12 +34,17 @@ def main():
     )
     parser.add_argument("-g", "--gui", action="store_true", help="Enable camera preview GUI")
     parser.add_argument("-c", "--config", type=str, default="config.json", help="Path to config JSON")
-    # parser.add_argument("-r", "--replay", type=str, help="Log file to replay")
-    # parser.add_argument("-f", "--fast", action="store_true", help="Replay faster than real time")
+    parser.add_argument("-r", "--replay", type=str, help="Log file to replay")
+    parser.add_argument("-f", "--fast", action="store_true", help="Replay faster than real time")
+    parser.add_argument("-o", "--offline", action="store_true", help="Replay without connecting to NetworkTables")
     args = parser.parse_args()
 
     conf = config.load_config(args.config)
 
+    if args.replay:
+        replay.run_replay(conf, args.replay, args.fast, args.offline)
+        return
+
     if conf.tag_family == "16h5":
         dict = cv2.aruco.DICT_APRILTAG_16H5
     elif conf.tag_family == "36h11":
@@ -39,73 +54,90 @@ def main():
         return
 
     # Connect to NetworkTables server
-    tag_env = config.TagEnvironment(0.1, {}) # Empty environment, real environment comes from robot code
+    # Empty environment, real environment comes from robot code
+    tag_env = config.SharedEnvironment(config.TagEnvironment(0.1, {}))
     nt = nt_io.NetworkTablesIO(conf.networktables)
+    nt.listen_environment(tag_env)
 
-    frame_queue = queue.PriorityQueue()
+    frame_queue = frame_buffer.FrameBuffer()
     result_queue = queue.PriorityQueue()
 
+    # Load control can change the worker count while running, within its bounds
+    max_workers = conf.load_control.max_workers if conf.load_control.enabled else conf.process_threads
+
+    # Enough buffers for the queued frame and every frame in process at once,
+    # plus the one being captured
+    pool_size = max_workers + 3
+
     threads = []
     for camera_config in conf.cameras:
         io = nt.get_camera_io(camera_config.name)
         res = camera_config.calibration.resolution
         io.publish_image_resolution(int(res[0]), int(res[1]))
-        threads.append(capture.CameraInputThread(camera_config, conf.frame_debug, frame_queue, io))
+        pool = frame_pool.FramePool(pool_size)
+        threads.append(capture.CameraInputThread(camera_config, conf.frame_debug, conf.recording, frame_queue, pool, io))
 
-    for _ in range(0, conf.process_threads):
-        threads.append(process.TagProcessThread(dict, tag_env, frame_queue, result_queue))
+    if conf.process_backend == "process":
+        workers = process_pool.ProcessWorkerPool(dict, tag_env, conf.cameras, conf.process_threads, frame_queue, result_queue, max_workers)
+    else:
+        workers = process.TagThreadPool(dict, tag_env, conf.cameras, conf.process_threads, frame_queue, result_queue)
+    threads.append(workers)
 
-    stream = web_stream.StreamServer(conf.stream)
+    stream = web_stream.StreamServer(conf.stream, [camera.name for camera in conf.cameras])
     stream.start()
 
+    def status_lines(result: process.FrameResult) -> list[str]:
+        return [
+            "Frame queue: " + str(frame_queue.qsize()),
+            "Result queue: " + str(result_queue.qsize()),
+            f"Frame age: {(time.monotonic() - result.frame.timestamp) :.3f}"
+        ]
+
+    # Frames are only annotated when someone is watching, and no faster than they're streamed
+    sinks = [output_dispatch.StreamSink(stream, status_lines)]
+    gui = None
+    if args.gui:
+        gui = output_dispatch.GuiSink(status_lines)
+        sinks.append(gui)
     if conf.logging.enabled:
         log_file_name = conf.logging.output_dir + "log_" + str(math.floor(random.random() * 1e16)) + ".ttlog"
-        logger = output_logger.FileLogger(log_file_name)
-    else:
-        logger = None
+        sinks.append(output_dispatch.LogSink(output_logger.FileLogger(log_file_name), nt))
+    dispatcher = output_dispatch.OutputDispatcher(nt, sinks)
+    dispatcher.start()
 
     for thread in threads:
         thread.start()
 
+    reorder_buffer = reorder.ReorderBuffer(frame_queue, conf.reorder_deadline)
+    stats_time = time.monotonic()
+    controller = None
+    if conf.load_control.enabled:
+        controller = load_control.LoadController(conf.load_control, [camera.name for camera in conf.cameras], frame_queue, workers, nt, stats_time)
+
     try:
-        camera_count = len(conf.cameras)
-        i = 0
-        prev_match_info = None
-        while True:
-            result = result_queue.get()
-            frame = result.frame
-
-            top = frame.image.shape[0] - 100
-            def put_text(text: str, pos, color):
-                cv2.putText(frame.image, text, pos, cv2.FONT_HERSHEY_SIMPLEX, 1, color, 2)
-            put_text("Frame queue: " + str(frame_queue.qsize()), (5, top), (64, 128, 255))
-            put_text("Result queue: " + str(result_queue.qsize()), (5, top + 40), (64, 128, 255))
-            put_text(f"Frame age: {(time.monotonic() - frame.timestamp) :.3f}", (5, top + 80), (64, 128, 255))
-
-            nt.publish_output(result)
-            stream.publish_frame(frame.camera, frame.image)
-
-            if logger:
-                match_info = nt.get_match_info()
-                if match_info != prev_match_info:
-                    print("Got match info:", match_info)
-                    logger.log_match_info(match_info)
-                    prev_match_info = match_info
-                
-                if len(result.detections) != 0:
-                    logger.log_tag_detects(frame.timestamp, frame.camera, result.detections)
-
-            nt.refresh_environment(tag_env)
-
-            if args.gui:
-                cv2.imshow(frame.camera, frame.image)
-                if i == 0 and cv2.waitKey(1) & 0xFF == ord('q'):
-                    break
-            
-            # Only waitKey once for all cameras
-            i += 1
-            if i >= camera_count:
-                i = 0
+        while gui is None or not gui.quit.is_set():
+            # Wake up for held results that reach their deadline, and
+            # otherwise only so quitting from the GUI is noticed
+            deadline = reorder_buffer.next_deadline()
+            timeout = 1 if deadline is None else max(0, deadline - time.monotonic())
+            try:
+                result = result_queue.get(timeout=timeout)
+                ready = reorder_buffer.push(result, time.monotonic())
+            except queue.Empty:
+                ready = []
+            ready += reorder_buffer.poll(time.monotonic())
+            for result in ready:
+                if controller is not None:
+                    controller.observe(result, time.monotonic())
+                dispatcher.dispatch(result)
+
+            now = time.monotonic()
+            if controller is not None:
+                controller.update(now)
+            if now - stats_time > 1:
+                for camera in reorder_buffer.cameras:
+                    nt.get_camera_io(camera).publish_reorder_stats(*reorder_buffer.get_stats(camera))
+                stats_time = now
     except KeyboardInterrupt as _:
         print("Interrupted...")
 
@@ -113,6 +145,8 @@ def main():
         thread.running = False
     for thread in threads:
         thread.join()
+    dispatcher.close()
+    nt.close()
 
     print("done :)")
 
@@ -1,10 +1,10 @@
 import ntcore
-import struct
 import time
 from dataclasses import dataclass
 from wpimath.geometry import *
 
 import config
+import pose_format
 import process
 import capture
 
@@ -17,56 +17,75 @@ class MatchInfo:
     is_red: bool
     station_num: int
 
-def append_pose(pose_data: list[float], pose: Pose3d):
-    tx = pose.translation()
-    q = pose.rotation().getQuaternion()
-
-    pose_data.extend([
-        tx.X(), tx.Y(), tx.Z(),
-        q.W(), q.X(), q.Y(), q.Z()
-    ])
-    
-def pack_estimate(est: tuple[Pose3d, float]) -> bytes:
-    pose, err = est
-
-    tx = pose.translation()
-    q = pose.rotation().getQuaternion()
-
-    return struct.pack(
-        ">fddddddd",
-        err,
-        tx.X(), tx.Y(), tx.Z(),
-        q.W(), q.X(), q.Y(), q.Z()
-    )
-
 class CameraNetworkTablesIO:
-    def __init__(self, camera: str):
+    def __init__(self, camera: str, conf: config.NetworkTablesConfig):
         self.inst = ntcore.NetworkTableInstance.getDefault()
         table = self.inst.getTable("/TagTracker/Cameras/" + camera)
 
         self.config_table = table.getSubTable("Config")
+        self.auto_exposure_entry = self.config_table.getEntry("Auto Exposure")
+        self.exposure_entry = self.config_table.getEntry("Exposure")
+        self.gain_entry = self.config_table.getEntry("Gain")
+        self.target_fps_entry = self.config_table.getEntry("Target FPS")
 
         output_table = table.getSubTable("Outputs")
         self.poses_pub = output_table.getRawTopic("poses").publish(
             "raw",
             ntcore.PubSubOptions(periodic=0, sendAll=True, keepDuplicates=True))
         self.fps_pub = output_table.getDoubleTopic("fps").publish()
+        # Detect time, solve time, detection scale
+        self.timings_pub = output_table.getDoubleArrayTopic("timings").publish()
         self.resolution_pub = output_table.getIntegerArrayTopic("resolution").publish()
         self.first_frame_filename_pub = output_table.getStringTopic("first_frame_filename").publish()
         self.alive_pub = output_table.getBooleanTopic("alive").publish()
+        self.dropped_frames_pub = output_table.getIntegerTopic("dropped_frames").publish()
+        self.pool_hits_pub = output_table.getIntegerTopic("pool_hits").publish()
+        self.pool_misses_pub = output_table.getIntegerTopic("pool_misses").publish()
+        # Seconds from closing the capture to the first frame after reopening it
+        self.reopen_latency_pub = output_table.getDoubleTopic("reopen_latency").publish()
+        # Results that came back ahead of an older frame, and results thrown
+        # away because a newer one was already published
+        self.reordered_results_pub = output_table.getIntegerTopic("reordered_results").publish()
+        self.discarded_results_pub = output_table.getIntegerTopic("discarded_results").publish()
+        # Load control keeps one of every frame_skip frames
+        self.frame_skip_pub = output_table.getIntegerTopic("frame_skip").publish()
+        self.skipped_frames_pub = output_table.getIntegerTopic("skipped_frames").publish()
         
         self.alive_pub.set(False)
-
-    def get_config_params(self) -> capture.CameraParams:
+        self.pose_encoder = pose_format.create_encoder(conf)
+
+        # Params are only read when they change or the robot connects. Until
+        # then there are none, and live cameras wait for them.
+        self.config_params = None
+        self.listeners = [
+            self.inst.addListener([self.config_table.getPath() + "/"], ntcore.EventFlags.kValueAll | ntcore.EventFlags.kImmediate, self.on_config_event),
+            self.inst.addConnectionListener(True, self.on_config_event)
+        ]
+
+    # Runs on the NT listener thread. Params are swapped in as a new object,
+    # and the last ones are kept while disconnected so the camera keeps running.
+    def on_config_event(self, event: ntcore.Event):
         if not self.inst.isConnected():
-            return None
+            return
 
-        return capture.CameraParams(
-            auto_exposure=self.config_table.getEntry("Auto Exposure").getBoolean(False),
-            exposure=self.config_table.getEntry("Exposure").getDouble(42),
-            gain=self.config_table.getEntry("Gain").getDouble(1),
-            target_fps=self.config_table.getEntry("Target FPS").getDouble(50)
+        params = capture.CameraParams(
+            auto_exposure=self.auto_exposure_entry.getBoolean(False),
+            exposure=self.exposure_entry.getDouble(42),
+            gain=self.gain_entry.getDouble(1),
+            target_fps=self.target_fps_entry.getDouble(50)
         )
+        if params != self.config_params:
+            self.config_params = params
+
+    # Latest params from NT, or None if they've never been received
+    def get_config_params(self) -> capture.CameraParams:
+        return self.config_params
+
+    # Listeners still registered when Python exits abort the process
+    def close(self):
+        for listener in self.listeners:
+            self.inst.removeListener(listener)
+        self.listeners = []
 
     def publish_image_resolution(self, width: int, height: int):
         self.resolution_pub.set([width, height])
@@ -77,59 +96,63 @@ class CameraNetworkTablesIO:
     def publish_alive(self, alive: bool):
         self.alive_pub.set(alive)
 
-    def publish_output(self, result: process.FrameResult):
-        est = result.estimates
-
-        if est:
-            pose_data = struct.pack(">?", True)
-            pose_data += pack_estimate(est.pose_a)
-            if est.pose_b is not None:
-                pose_data += struct.pack(">?", True)
-                pose_data += pack_estimate(est.pose_b)
-                pose_data += struct.pack(">B", len(result.detections))
-            else:
-                pose_data += struct.pack(">?", False)
-                # Length not needed, guaranteed to be exactly one tag
-            for detection in result.detections:
-                corners = detection.corners[0]
-                pose_data += struct.pack(
-                    ">BHHHHHHHH",
-                    detection.id,
-
-                    # Send the corners for visualization in AdvantageScope
-                    round(corners[0][0]), round(corners[0][1]),
-                    round(corners[1][0]), round(corners[1][1]),
-                    round(corners[2][0]), round(corners[2][1]),
-                    round(corners[3][0]), round(corners[3][1])
-                )
-        else:
-            pose_data = struct.pack(">?", False)
+    def publish_dropped_frames(self, count: int):
+        self.dropped_frames_pub.set(count)
 
-        # Send it
+    def publish_reopen_latency(self, seconds: float):
+        self.reopen_latency_pub.set(seconds)
+
+    def publish_pool_stats(self, hits: int, misses: int):
+        self.pool_hits_pub.set(hits)
+        self.pool_misses_pub.set(misses)
+
+    def publish_reorder_stats(self, reordered: int, discarded: int):
+        self.reordered_results_pub.set(reordered)
+        self.discarded_results_pub.set(discarded)
+
+    def publish_frame_skip(self, skip: int, skipped: int):
+        self.frame_skip_pub.set(skip)
+        self.skipped_frames_pub.set(skipped)
+
+    def publish_output(self, result: process.FrameResult):
         # Send how long it took to process the frame for latency correction
-        pose_data += struct.pack(">d", time.monotonic() - result.frame.timestamp)
+        pose_data = self.pose_encoder.encode(result.estimates, result.detections, time.monotonic() - result.frame.timestamp)
         self.poses_pub.set(pose_data)
         self.fps_pub.set(result.frame.rate)
+        timings = result.timings
+        self.timings_pub.set([timings.detect, timings.solve, timings.scale])
 
 class NetworkTablesIO:
     cameras: dict[str, CameraNetworkTablesIO]
     fms: ntcore.NetworkTable
 
-    def __init__(self, conf: config.NetworkTablesConfig):
+    # With connect=False nothing leaves the process, outputs are only published locally
+    def __init__(self, conf: config.NetworkTablesConfig, connect: bool = True):
+        self.conf = conf
         self.cameras = {}
 
         nt = ntcore.NetworkTableInstance.getDefault()
-        nt.setServer(conf.server_ip)
-        nt.startClient4(conf.identity)
+        if connect:
+            nt.setServer(conf.server_ip)
+            nt.startClient4(conf.identity)
 
+        self.inst = nt
         table = nt.getTable("/TagTracker")
         self.env_entry = table.getEntry("Environment")
+        self.env_listener = None
+        self.fms = nt.getTable("/FMSInfo")
 
-        self.prev_env_change = None
+        load_table = table.getSubTable("LoadControl")
+        self.workers_pub = load_table.getIntegerTopic("workers").publish()
+        # 90th percentile capture to publish latency, and how much of the
+        # average was spent queued and processing
+        self.latency_pub = load_table.getDoubleTopic("latency").publish()
+        self.queued_pub = load_table.getDoubleTopic("queued").publish()
+        self.processing_pub = load_table.getDoubleTopic("processing").publish()
 
     def get_camera_io(self, cam_name: str) -> CameraNetworkTablesIO:
         if not cam_name in self.cameras:
-            io = CameraNetworkTablesIO(cam_name)
+            io = CameraNetworkTablesIO(cam_name, self.conf)
             self.cameras[cam_name] = io
             return io
         else:
@@ -140,6 +163,19 @@ class NetworkTablesIO:
         io = self.get_camera_io(frame.camera)
         io.publish_output(result)
 
+    def publish_load_control(self, workers: int, latency: float, queued: float, processing: float):
+        self.workers_pub.set(workers)
+        self.latency_pub.set(latency)
+        self.queued_pub.set(queued)
+        self.processing_pub.set(processing)
+
+    def close(self):
+        for io in self.cameras.values():
+            io.close()
+        if self.env_listener is not None:
+            self.inst.removeListener(self.env_listener)
+            self.env_listener = None
+
     def get_match_info(self) -> MatchInfo:
         return MatchInfo(
             event_name=self.fms.getString("EventName", "UNKNOWN"),
@@ -150,21 +186,23 @@ class NetworkTablesIO:
             station_num=self.fms.getEntry("StationNumber").getInteger(999999)
         )
     
-    # Modifies the contents of env
-    def refresh_environment(self, env: config.TagEnvironment):
-        # Skip if no change
-        last_change = self.env_entry.getLastChange()
-        if last_change == self.prev_env_change:
-            return
-        self.prev_env_change = last_change
-
-        print("Updating tag environment")
-        data = self.env_entry.getDoubleArray([])
+    # Swaps a new snapshot into env whenever the robot publishes a new
+    # layout, and right away if it already has. The listener runs on its own
+    # thread.
+    def listen_environment(self, env: config.SharedEnvironment):
+        def on_change(event: ntcore.Event):
+            value = event.data.value
+            if not value.isDoubleArray():
+                return
+            self.update_environment(env, value.getDoubleArray())
+        self.env_listener = self.inst.addListener(self.env_entry, ntcore.EventFlags.kValueAll | ntcore.EventFlags.kImmediate, on_change)
+
+    def update_environment(self, env: config.SharedEnvironment, data: list[float]):
         if len(data) == 0:
             return
+        print("Updating tag environment")
 
-        env.tag_size = data[0]
-        env.tags = {}
+        tags = {}
 
         for i in range(1, len(data), 8):
             tag_id = int(data[i])
@@ -181,4 +219,6 @@ class NetworkTablesIO:
             rotation = Rotation3d(Quaternion(qw, qx, qy, qz))
             pose = Pose3d(translation, rotation)
 
-            env.tags[tag_id] = pose
+            tags[tag_id] = pose
+
+        env.update(data[0], tags)
@@ -0,0 +1,179 @@
+# Fans results out from the main thread to everything that uses them. NT
+# publishing is the only thing the robot is waiting on, so it stays inline on
+# the main thread and goes first. The stream, logger and GUI each get their
+# own thread with a small bounded queue, so a slow imshow or disk only makes
+# that output drop results instead of delaying poses for every camera.
+import collections
+import cv2
+import threading
+import time
+from typing import Callable
+
+import nt_io
+import output_logger
+import overlay
+import process
+import web_stream
+
+# What a full sink queue throws away to make room
+DROP_OLDEST = "drop-oldest" # Only the latest result matters, like previews
+DROP_NEWEST = "drop-newest" # Keep what's queued in order, like logs
+
+class OutputSink(threading.Thread):
+    name: str
+    # Results queued at once, for each camera if per_camera
+    depth: int
+    policy: str
+    per_camera: bool
+    # Whether handle() uses the frame's image. Sinks that don't use it don't
+    # hold a reference, so their queue doesn't keep pool buffers from coming back.
+    uses_image: bool
+    dropped: int
+    running: bool
+
+    def __init__(self, name: str, depth: int, policy: str, uses_image: bool, per_camera: bool = False):
+        threading.Thread.__init__(self)
+        self.name = name
+        self.depth = max(1, depth)
+        self.policy = policy
+        self.per_camera = per_camera
+        self.uses_image = uses_image
+        self.results = collections.deque()
+        self.cond = threading.Condition()
+        self.dropped = 0
+        self.running = True
+
+    # Called on the main thread before offering, so sinks can skip results
+    # without queueing them
+    def wants(self, result: process.FrameResult, now: float) -> bool:
+        return True
+
+    # Called on the sink's thread
+    def handle(self, result: process.FrameResult):
+        raise NotImplementedError()
+
+    def offer(self, result: process.FrameResult):
+        if self.uses_image:
+            result.frame.retain()
+        dropped = None
+        with self.cond:
+            if self.per_camera:
+                camera = result.frame.camera
+                queued = [i for i, r in enumerate(self.results) if r.frame.camera == camera]
+            else:
+                queued = range(len(self.results))
+            if len(queued) >= self.depth:
+                self.dropped += 1
+                if self.policy == DROP_NEWEST:
+                    dropped = result
+                else:
+                    dropped = self.results[queued[0]]
+                    del self.results[queued[0]]
+            if dropped is not result:
+                self.results.append(result)
+                self.cond.notify()
+        if dropped is not None and self.uses_image:
+            dropped.frame.release()
+
+    def run(self):
+        while self.running:
+            with self.cond:
+                if not self.cond.wait_for(lambda: len(self.results) != 0, timeout=1):
+                    continue
+                result = self.results.popleft()
+            try:
+                self.handle(result)
+            except Exception as e:
+                # One bad result shouldn't stop the output for good
+                print("Output", self.name, "failed:", repr(e))
+            finally:
+                if self.uses_image:
+                    result.frame.release()
+
+        with self.cond:
+            leftover = list(self.results)
+            self.results.clear()
+        if self.uses_image:
+            for result in leftover:
+                result.frame.release()
+
+# Annotates frames for viewers of the web stream, no faster than it's streamed
+class StreamSink(OutputSink):
+    def __init__(self, stream: web_stream.StreamServer, status_lines: Callable[[process.FrameResult], list[str]]):
+        OutputSink.__init__(self, "stream", 1, DROP_OLDEST, True)
+        self.stream = stream
+        self.status_lines = status_lines
+        self.limiter = overlay.OverlayRateLimiter(web_stream.max_fps)
+
+    def wants(self, result: process.FrameResult, now: float) -> bool:
+        camera = result.frame.camera
+        return self.stream.has_clients(camera) and self.limiter.is_due(camera, now)
+
+    def handle(self, result: process.FrameResult):
+        image = overlay.annotate_result(result, self.status_lines(result))
+        self.stream.publish_frame(result.frame.camera, image)
+
+# Preview windows. HighGUI only draws during waitKey, so this thread does both.
+# Each camera keeps its own latest result, so a busy camera can't starve the
+# other windows.
+class GuiSink(OutputSink):
+    quit: threading.Event
+
+    def __init__(self, status_lines: Callable[[process.FrameResult], list[str]]):
+        OutputSink.__init__(self, "gui", 1, DROP_OLDEST, True, per_camera=True)
+        self.status_lines = status_lines
+        self.quit = threading.Event()
+
+    def handle(self, result: process.FrameResult):
+        cv2.imshow(result.frame.camera, overlay.annotate_result(result, self.status_lines(result)))
+        if cv2.waitKey(1) & 0xFF == ord('q'):
+            self.quit.set()
+
+class LogSink(OutputSink):
+    def __init__(self, logger: output_logger.FileLogger, nt: nt_io.NetworkTablesIO):
+        OutputSink.__init__(self, "logger", 256, DROP_NEWEST, False)
+        self.logger = logger
+        self.nt = nt
+        self.prev_match_info = None
+
+    def handle(self, result: process.FrameResult):
+        match_info = self.nt.get_match_info()
+        if match_info != self.prev_match_info:
+            print("Got match info:", match_info)
+            self.logger.log_match_info(match_info)
+            self.prev_match_info = match_info
+
+        frame = result.frame
+        if len(result.detections) != 0:
+            self.logger.log_tag_detects(frame.timestamp, frame.camera, result.detections)
+
+class OutputDispatcher:
+    nt: nt_io.NetworkTablesIO
+    sinks: list[OutputSink]
+
+    def __init__(self, nt: nt_io.NetworkTablesIO, sinks: list[OutputSink]):
+        self.nt = nt
+        self.sinks = sinks
+
+    def start(self):
+        for sink in self.sinks:
+            sink.start()
+
+    # Publishes to NT right away, then queues the result for every sink that
+    # wants it. The main thread's reference to the frame is released here.
+    def dispatch(self, result: process.FrameResult):
+        self.nt.publish_output(result)
+
+        now = time.monotonic()
+        for sink in self.sinks:
+            if sink.wants(result, now):
+                sink.offer(result)
+        result.frame.release()
+
+    def close(self):
+        for sink in self.sinks:
+            sink.running = False
+        for sink in self.sinks:
+            sink.join()
+            if sink.dropped != 0:
+                print("Output", sink.name, "dropped", sink.dropped, "results")
@@ -1,33 +1,39 @@
+import numpy
 import os
 import queue
 import struct
 import threading
 import time
+from dataclasses import dataclass
+from typing import Iterator
 from wpimath.geometry import *
 
 import detect
 import nt_io
+import pose_math
 
 START_BYTE = 0x5A
 
+EVENT_TAG_DETECTS = 0
+EVENT_MATCH_INFO = 1
+
+@dataclass
+class LogEvent:
+    timestamp: float
+    event_id: int
+    camera: str
+    data: bytes
+
 def pack_header(timestamp: float, event_id: int, cam: str) -> bytes:
     cam_data = cam.encode()
     data = struct.pack(">bdbb", START_BYTE, timestamp, event_id, len(cam_data))
     data += cam_data
     return data
 
-def pack_estimate(est: tuple[Pose3d, float]) -> bytes:
+def pack_estimate(est: tuple[pose_math.Pose, float]) -> bytes:
     pose, err = est
-
-    t = pose.translation()
-    q = pose.rotation().getQuaternion()
-    tx = t.X()
-    ty = t.Y()
-    tz = t.Z()
-    qw = q.W()
-    qx = q.X()
-    qy = q.Y()
-    qz = q.Z()
+    tx, ty, tz = pose.translation
+    qw, qx, qy, qz = pose.quaternion
 
     return struct.pack(">dddddddd", err, tx, ty, tz, qw, qx, qy, qz)
 
@@ -84,7 +90,7 @@ class FileLogger:
             for corner in corners[0]:
                 data += struct.pack(">dd", corner[0], corner[1])
 
-        self.write_event(frame_timestamp, 0, cam, data)
+        self.write_event(frame_timestamp, EVENT_TAG_DETECTS, cam, data)
 
     def log_match_info(self, info: nt_io.MatchInfo):
         event_data = info.event_name.encode()
@@ -99,4 +105,55 @@ class FileLogger:
             info.station_num
         )
 
-        self.write_event(time.monotonic(), 1, "", data)
+        self.write_event(time.monotonic(), EVENT_MATCH_INFO, "", data)
+
+# Reads back the events written by FileLogger, in the order they were logged
+def read_log(file_name: str) -> Iterator[LogEvent]:
+    with open(file_name, "rb") as file:
+        data = file.read()
+
+    pos = 0
+    while pos + 3 <= len(data):
+        start, length = struct.unpack_from(">bH", data, pos)
+        if start != START_BYTE:
+            # Probably a partially written event, resync on the next start byte
+            pos += 1
+            continue
+        pos += 3
+        if pos + length > len(data):
+            # Log was cut off while writing the last event
+            break
+
+        timestamp, event_id, cam_len = struct.unpack_from(">dbb", data, pos)
+        cam_start = pos + struct.calcsize(">dbb")
+        cam = data[cam_start:cam_start + cam_len].decode()
+        yield LogEvent(timestamp, event_id, cam, data[cam_start + cam_len:pos + length])
+        pos += length
+
+def unpack_tag_detects(data: bytes) -> list[detect.DetectedTag]:
+    count, = struct.unpack_from(">b", data, 0)
+    pos = 1
+
+    detections = []
+    for _ in range(count):
+        tag_id, corner_count = struct.unpack_from(">bb", data, pos)
+        pos += 2
+        corners = numpy.frombuffer(data, dtype=">f8", count=corner_count * 2, offset=pos)
+        pos += corner_count * 16
+
+        # Same shape and type as what ArucoDetector gives
+        detections.append(detect.DetectedTag(tag_id, corners.astype(numpy.float32).reshape(1, corner_count, 2)))
+    return detections
+
+def unpack_match_info(data: bytes) -> nt_io.MatchInfo:
+    name_len, = struct.unpack_from(">H", data, 0)
+    event_name = data[2:2 + name_len].decode()
+    match_num, match_type, replay_num, is_red, station_num = struct.unpack_from(">iii?i", data, 2 + name_len)
+    return nt_io.MatchInfo(
+        event_name=event_name,
+        match_num=match_num,
+        match_type=match_type,
+        replay_num=replay_num,
+        is_red=is_red,
+        station_num=station_num
+    )
@@ -0,0 +1,71 @@
+import cv2
+import numpy
+
+import process
+
+# Draws the tags, timings and estimates for a result onto a copy of the frame,
+# so the image the detector saw is left as it was. status_lines go along the
+# bottom of the image.
+def annotate_result(result: process.FrameResult, status_lines: list[str]) -> cv2.Mat:
+    frame = result.frame
+    timings = result.timings
+    # Scale of the image drawn on, relative to the calibrated resolution
+    scale = frame.scale
+    if frame.encoded is not None and (frame.image.ndim == 2 or frame.scale != 1):
+        # The detector got a grayscale or reduced decode, viewers still get
+        # the full color frame. Only decoded for frames someone will see.
+        image = cv2.imdecode(frame.encoded, cv2.IMREAD_COLOR)
+        scale = 1
+    elif frame.image.ndim == 2:
+        # Converting to color makes the copy
+        image = cv2.cvtColor(frame.image, cv2.COLOR_GRAY2BGR)
+    else:
+        image = frame.image.copy()
+
+    for tag in result.detections:
+        cv2.aruco.drawDetectedMarkers(image, numpy.array([tag.corners / scale]), numpy.array([tag.id]))
+    def put_text(text: str, pos, color):
+        cv2.putText(image, text, pos, cv2.FONT_HERSHEY_SIMPLEX, 1, color, 2)
+    put_text(frame.camera, (5, 40), (255, 255, 64))
+    put_text("FPS: " + str(frame.rate), (5, 80), (64, 255, 64))
+    put_text(f"Detect: {timings.detect * 1000 :.2f} ms @ {timings.scale :.2f}x", (5, 120), (64, 255, 64))
+    put_text(f"Solve: {timings.solve * 1000 :.2f} ms", (5, 160), (64, 255, 64))
+
+    est = result.estimates
+    if est is None:
+        put_text(f"No estimates this frame :(", (5, 200), (64, 255, 64))
+    else:
+        a = est.pose_a
+        b = est.pose_b
+
+        def format_pose(pose):
+            if pose is None:
+                return "None"
+
+            tx = pose[0].translation
+            return f"{tx[0]:.2f}, {tx[1]:.2f}, {tx[2]:.2f} | e {pose[1]:.4f}"
+
+        put_text(f"Est A: {format_pose(a)}", (5, 200), (64, 255, 64))
+        put_text(f"Est B: {format_pose(b)}", (5, 240), (64, 255, 64))
+
+    top = image.shape[0] - 20 - 40 * (len(status_lines) - 1)
+    for i, line in enumerate(status_lines):
+        put_text(line, (5, top + 40 * i), (64, 128, 255))
+    return image
+
+# Annotating is only worth it for frames someone will see, so cameras faster
+# than the stream only get every few frames annotated
+class OverlayRateLimiter:
+    def __init__(self, max_fps: float):
+        self.interval = 1 / max_fps
+        self.next_time = {}
+
+    def is_due(self, camera: str, now: float) -> bool:
+        next_time = self.next_time.get(camera)
+        if next_time is not None and now < next_time:
+            return False
+        # Don't try to catch up on frames that were skipped
+        if next_time is None or now - next_time > self.interval:
+            next_time = now
+        self.next_time[camera] = next_time + self.interval
+        return True
@@ -0,0 +1,183 @@
+# Packs a frame's estimates and detections into the payload of the poses
+# topic. Runs on the main thread for every result from every camera, so the
+# layouts are compiled once and each camera packs into the same buffer every
+# frame instead of joining a new bytes object per field.
+#
+# Version 1 layout, all big endian:
+#   ? has estimates
+#   if it does:
+#     f error, ddd translation, dddd quaternion (w, x, y, z) for estimate A
+#     ? has estimate B
+#     if it does: estimate B like A, then B tag count
+#     per tag: B ID, HHHHHHHH corners in pixels (for AdvantageScope)
+#   d seconds between capture and publishing
+#
+# Version 2 is under half the size, for many cameras on the field radio. Its
+# first byte is 2, which version 1 never starts with. Big endian:
+#   B version, B flags (see HAS_*), f seconds between capture and publishing
+#   per estimate in flags, A then B:
+#     f error, fff translation, hhhh quaternion (w, x, y, z) * QUATERNION_SCALE
+#   B tag count
+#   per tag: B ID, then HHHHHHHH corners in pixels if HAS_CORNERS is set
+# decode_v2 is the reference decoder.
+import numpy
+import struct
+
+import config
+import detect
+import pose_math
+import solve
+
+FLAG = struct.Struct(">?")
+ESTIMATE = struct.Struct(">fddddddd")
+TAG_COUNT = struct.Struct(">B")
+LATENCY = struct.Struct(">d")
+TAG = numpy.dtype([("id", "u1"), ("corners", ">u2", (8,))])
+
+# Largest payload without the tags
+HEADER_SIZE = FLAG.size * 2 + ESTIMATE.size * 2 + TAG_COUNT.size + LATENCY.size
+
+V2_HEADER = struct.Struct(">BBf")
+V2_ESTIMATE = struct.Struct(">ffffhhhh")
+HAS_ESTIMATE_A = 1
+HAS_ESTIMATE_B = 2
+HAS_CORNERS = 4
+# Quaternions are normalized, so every component fits in an int16 this way,
+# to within about 3e-5
+QUATERNION_SCALE = 32767
+
+V2_HEADER_SIZE = V2_HEADER.size + V2_ESTIMATE.size * 2 + TAG_COUNT.size
+
+def pack_estimate(buf: bytearray, offset: int, est: tuple[pose_math.Pose, float]) -> int:
+    pose, err = est
+    tx = pose.translation
+    q = pose.quaternion
+    ESTIMATE.pack_into(buf, offset, err, tx[0], tx[1], tx[2], q[0], q[1], q[2], q[3])
+    return offset + ESTIMATE.size
+
+# Every detection's ID and corners in one go through a NumPy view of buf
+def pack_tags(buf: bytearray, offset: int, detections: list[detect.DetectedTag]) -> int:
+    count = len(detections)
+    if count == 0:
+        return offset
+    corners = numpy.concatenate([detection.corners for detection in detections]).reshape(count, 8)
+    tags = numpy.frombuffer(buf, TAG, count, offset)
+    tags["id"] = [detection.id for detection in detections]
+    # Corners just off the edge of the image would otherwise wrap around
+    numpy.maximum(numpy.rint(corners, out=corners), 0, out=corners)
+    tags["corners"] = corners
+    return offset + count * TAG.itemsize
+
+class PoseEncoder:
+    buffer: bytearray
+
+    def __init__(self):
+        self.buffer = bytearray(HEADER_SIZE)
+
+    # The view is into a buffer the next encode reuses, so it has to be
+    # published (which copies it) before then
+    def encode(self, est: solve.EstimatePair, detections: list[detect.DetectedTag], latency: float) -> memoryview:
+        size = HEADER_SIZE + len(detections) * TAG.itemsize
+        if len(self.buffer) < size:
+            self.buffer = bytearray(size)
+        buf = self.buffer
+
+        if est:
+            FLAG.pack_into(buf, 0, True)
+            offset = pack_estimate(buf, FLAG.size, est.pose_a)
+            if est.pose_b is not None:
+                FLAG.pack_into(buf, offset, True)
+                offset = pack_estimate(buf, offset + FLAG.size, est.pose_b)
+                TAG_COUNT.pack_into(buf, offset, len(detections))
+                offset += TAG_COUNT.size
+            else:
+                # Length not needed, guaranteed to be exactly one tag
+                FLAG.pack_into(buf, offset, False)
+                offset += FLAG.size
+            offset = pack_tags(buf, offset, detections)
+        else:
+            FLAG.pack_into(buf, 0, False)
+            offset = FLAG.size
+
+        LATENCY.pack_into(buf, offset, latency)
+        return memoryview(buf)[:offset + LATENCY.size]
+
+def pack_estimate_v2(buf: bytearray, offset: int, est: tuple[pose_math.Pose, float]) -> int:
+    pose, err = est
+    tx = pose.translation
+    w, x, y, z = pose.quaternion.tolist()
+    V2_ESTIMATE.pack_into(buf, offset, err, tx[0], tx[1], tx[2],
+                          round(w * QUATERNION_SCALE), round(x * QUATERNION_SCALE),
+                          round(y * QUATERNION_SCALE), round(z * QUATERNION_SCALE))
+    return offset + V2_ESTIMATE.size
+
+class PoseEncoderV2:
+    buffer: bytearray
+
+    # Without corners only the tag IDs are sent
+    def __init__(self, corners: bool):
+        self.corners = corners
+        self.tag_size = TAG.itemsize if corners else 1
+        self.buffer = bytearray(V2_HEADER_SIZE)
+
+    # Same as PoseEncoder.encode
+    def encode(self, est: solve.EstimatePair, detections: list[detect.DetectedTag], latency: float) -> memoryview:
+        size = V2_HEADER_SIZE + len(detections) * self.tag_size
+        if len(self.buffer) < size:
+            self.buffer = bytearray(size)
+        buf = self.buffer
+
+        flags = HAS_CORNERS if self.corners else 0
+        offset = V2_HEADER.size
+        if est:
+            flags |= HAS_ESTIMATE_A
+            offset = pack_estimate_v2(buf, offset, est.pose_a)
+            if est.pose_b is not None:
+                flags |= HAS_ESTIMATE_B
+                offset = pack_estimate_v2(buf, offset, est.pose_b)
+        V2_HEADER.pack_into(buf, 0, 2, flags, latency)
+
+        TAG_COUNT.pack_into(buf, offset, len(detections))
+        offset += TAG_COUNT.size
+        if self.corners:
+            offset = pack_tags(buf, offset, detections)
+        else:
+            buf[offset:offset + len(detections)] = bytes([detection.id for detection in detections])
+            offset += len(detections)
+        return memoryview(buf)[:offset]
+
+def create_encoder(conf: config.NetworkTablesConfig) -> PoseEncoder | PoseEncoderV2:
+    if conf.output_format == 2:
+        return PoseEncoderV2(conf.send_corners)
+    return PoseEncoder()
+
+def unpack_estimate_v2(data: bytes, offset: int) -> tuple[pose_math.Pose, float]:
+    err, x, y, z, qw, qx, qy, qz = V2_ESTIMATE.unpack_from(data, offset)
+    q = numpy.array([qw, qx, qy, qz]) / QUATERNION_SCALE
+    return (pose_math.Pose(numpy.array([x, y, z]), q / numpy.linalg.norm(q)), err)
+
+# Reference decoder for version 2. Returns the estimates (None if there are
+# none), tag IDs, tag corners shaped (tags, 4, 2) or None if they weren't
+# sent, and the latency.
+def decode_v2(data: bytes) -> tuple[solve.EstimatePair, list[int], numpy.ndarray, float]:
+    version, flags, latency = V2_HEADER.unpack_from(data, 0)
+    if version != 2:
+        raise ValueError("Not a version 2 payload, starts with " + str(version))
+    offset = V2_HEADER.size
+
+    est = None
+    if flags & HAS_ESTIMATE_A:
+        pose_a = unpack_estimate_v2(data, offset)
+        offset += V2_ESTIMATE.size
+        pose_b = None
+        if flags & HAS_ESTIMATE_B:
+            pose_b = unpack_estimate_v2(data, offset)
+            offset += V2_ESTIMATE.size
+        est = solve.EstimatePair(pose_a=pose_a, pose_b=pose_b)
+
+    count, = TAG_COUNT.unpack_from(data, offset)
+    offset += TAG_COUNT.size
+    if flags & HAS_CORNERS:
+        tags = numpy.frombuffer(data, TAG, count, offset)
+        return (est, tags["id"].tolist(), tags["corners"].reshape(count, 4, 2).astype(numpy.float64), latency)
+    return (est, list(data[offset:offset + count]), None, latency)
@@ -0,0 +1,82 @@
+# Pose math on plain NumPy arrays. Solving used to build several wpimath
+# Pose3d/Transform3d/Rotation3d objects per frame only to read the numbers
+# back out, these do the same math directly. Poses are a translation vector
+# and a 3x3 rotation matrix until they're turned into a Pose at the end.
+# Arrays are tiny here, so these avoid anything that costs more NumPy calls
+# than it saves.
+import cv2
+import math
+import numpy
+import numpy.typing
+from dataclasses import dataclass
+
+# OpenCV axes (from perspective of camera) are +X right, +Y down, +Z forward
+# WPI axes (from perspective of identity pose) are +X forward, +Y left, +Z up
+# So (wpi_x, wpi_y, wpi_z) = (cv_z, -cv_x, -cv_y), or wpi = CV_TO_WPI @ cv
+CV_TO_WPI = numpy.array([
+    [0.0, 0.0, 1.0],
+    [-1.0, 0.0, 0.0],
+    [0.0, -1.0, 0.0]
+])
+
+@dataclass
+class Pose:
+    translation: numpy.typing.NDArray[numpy.float64] # x, y, z
+    quaternion: numpy.typing.NDArray[numpy.float64] # w, x, y, z, normalized with w >= 0
+
+# OpenCV tvec and rvec to WPI translation and rotation matrix
+def cv_to_wpi(tvec: numpy.ndarray, rvec: numpy.ndarray) -> tuple[numpy.ndarray, numpy.ndarray]:
+    # rvec encodes axis as its direction and angle in radians as its magnitude.
+    # Remapping the axis gives CV_TO_WPI @ R @ CV_TO_WPI.T for less work.
+    r, _ = cv2.Rodrigues(CV_TO_WPI @ rvec)
+    return ((CV_TO_WPI @ tvec).reshape(3), r)
+
+def invert(t: numpy.ndarray, r: numpy.ndarray) -> tuple[numpy.ndarray, numpy.ndarray]:
+    r_inv = r.T
+    return (-(r_inv @ t), r_inv)
+
+# Applies transform b in the frame of pose a, like Pose3d.transformBy
+def compose(t_a: numpy.ndarray, r_a: numpy.ndarray, t_b: numpy.ndarray, r_b: numpy.ndarray) -> tuple[numpy.ndarray, numpy.ndarray]:
+    return (t_a + r_a @ t_b, r_a @ r_b)
+
+def quaternion_to_matrix(q: numpy.ndarray) -> numpy.ndarray:
+    w, x, y, z = q / numpy.linalg.norm(q)
+    return numpy.array([
+        [1 - 2 * (y * y + z * z), 2 * (x * y - z * w), 2 * (x * z + y * w)],
+        [2 * (x * y + z * w), 1 - 2 * (x * x + z * z), 2 * (y * z - x * w)],
+        [2 * (x * z - y * w), 2 * (y * z + x * w), 1 - 2 * (x * x + y * y)]
+    ])
+
+# Divides by whichever of w, x, y, z is largest, so it stays accurate for
+# every rotation. Plain floats, since NumPy calls cost more than the math.
+def matrix_to_quaternion(r: numpy.ndarray) -> numpy.ndarray:
+    (m00, m01, m02), (m10, m11, m12), (m20, m21, m22) = r.tolist()
+    trace = m00 + m11 + m22
+    if trace > 0:
+        s = 2 * math.sqrt(1 + trace)
+        q = [s / 4, (m21 - m12) / s, (m02 - m20) / s, (m10 - m01) / s]
+    elif m00 > m11 and m00 > m22:
+        s = 2 * math.sqrt(1 + m00 - m11 - m22)
+        q = [(m21 - m12) / s, s / 4, (m01 + m10) / s, (m02 + m20) / s]
+    elif m11 > m22:
+        s = 2 * math.sqrt(1 - m00 + m11 - m22)
+        q = [(m02 - m20) / s, (m01 + m10) / s, s / 4, (m12 + m21) / s]
+    else:
+        s = 2 * math.sqrt(1 - m00 - m11 + m22)
+        q = [(m10 - m01) / s, (m02 + m20) / s, (m12 + m21) / s, s / 4]
+
+    norm = math.sqrt(q[0] * q[0] + q[1] * q[1] + q[2] * q[2] + q[3] * q[3])
+    # q and -q are the same rotation, keep w positive so outputs are consistent
+    if q[0] < 0:
+        norm = -norm
+    return numpy.array([q[0] / norm, q[1] / norm, q[2] / norm, q[3] / norm])
+
+def to_pose(t: numpy.ndarray, r: numpy.ndarray) -> Pose:
+    return Pose(t, matrix_to_quaternion(r))
+
+# Angle in radians between the rotations of two rvecs
+def rotation_angle(rvec_a: numpy.ndarray, rvec_b: numpy.ndarray) -> float:
+    r_a, _ = cv2.Rodrigues(rvec_a)
+    r_b, _ = cv2.Rodrigues(rvec_b)
+    cos = (numpy.trace(r_a.T @ r_b) - 1) / 2
+    return math.acos(max(-1.0, min(1.0, cos)))
@@ -1,5 +1,3 @@
-import cv2
-import numpy
 import queue
 import threading
 import time
@@ -8,12 +6,17 @@ from dataclasses import dataclass, field
 import capture
 import config
 import detect
+import frame_buffer
 import solve
 
 @dataclass
 class ProcessTimings:
     detect: float
     solve: float
+    # Scale of the image tags were detected in, relative to the calibrated resolution
+    scale: float = 1.0
+    # From capture until a worker started on the frame
+    queued: float = 0
 
 @dataclass(order=True)
 class FrameResult:
@@ -22,18 +25,59 @@ class FrameResult:
     estimates: solve.EstimatePair = field(compare=False)
     timings: ProcessTimings = field(compare=False)
 
+# Finds the tags in a frame and estimates the camera pose from them
+# track is the camera's solve.PoseTrack, if it has warm starts enabled
+def process_frame(detector: detect.TagDetector, estimator: solve.PoseEstimator, frame: capture.CameraFrame, track: solve.PoseTrack = None) -> FrameResult:
+    queued = time.monotonic() - frame.timestamp
+    begin_time = time.time()
+    detections = detector.detect(frame.image, frame.timestamp)
+    if frame.scale != 1:
+        # Corners have to be in calibrated resolution for solving
+        for tag in detections:
+            tag.corners *= frame.scale
+    after_detect = time.time()
+    estimates = estimator.solve(frame.calibration, detections, track, frame.timestamp)
+    after_solve = time.time()
+
+    return FrameResult(
+        frame=frame,
+        detections=detections,
+        estimates=estimates,
+        timings=ProcessTimings(
+            detect=after_detect - begin_time,
+            solve=after_solve - after_detect,
+            scale=detector.last_scale / frame.scale,
+            queued=queued
+        )
+    )
+
+# One tracking state per camera, shared by every worker's detectors
+def create_tracking(cameras: list[config.CameraSettings]) -> dict[str, detect.CameraTracking]:
+    return {camera.name: detect.CameraTracking() for camera in cameras}
+
+# One detector per camera per worker, using the camera's shared tracking
+def create_detectors(aruco_dict: int, cameras: list[config.CameraSettings], tracking: dict[str, detect.CameraTracking]) -> dict[str, detect.TagDetector]:
+    return {camera.name: detect.TagDetector(aruco_dict, camera.detector, tracking[camera.name]) for camera in cameras}
+
+# Likewise one shared pose track per camera, for the cameras that use warm starts
+def create_pose_tracks(cameras: list[config.CameraSettings]) -> dict[str, solve.PoseTrack]:
+    return {camera.name: solve.PoseTrack(camera.solver) for camera in cameras if camera.solver.warm_start}
+
 class TagProcessThread(threading.Thread):
-    frame_queue: queue.PriorityQueue[capture.CameraFrame]
+    frame_queue: frame_buffer.FrameBuffer
     result_queue: queue.PriorityQueue[FrameResult]
-    detector: detect.TagDetector
+    detectors: dict[str, detect.TagDetector]
     estimator: solve.PoseEstimator
     running: bool
 
-    def __init__(self, aruco_dict: int, env: config.TagEnvironment, frame_queue: queue.PriorityQueue[capture.CameraFrame], result_queue: queue.PriorityQueue[FrameResult]):
+    # tracking and tracks are from create_tracking and create_pose_tracks,
+    # shared by all process threads
+    def __init__(self, aruco_dict: int, env: config.SharedEnvironment, cameras: list[config.CameraSettings], frame_queue: frame_buffer.FrameBuffer, result_queue: queue.PriorityQueue[FrameResult], tracking: dict[str, detect.CameraTracking], tracks: dict[str, solve.PoseTrack]):
         threading.Thread.__init__(self)
         self.frame_queue = frame_queue
         self.result_queue = result_queue
-        self.detector = detect.TagDetector(aruco_dict)
+        self.detectors = create_detectors(aruco_dict, cameras, tracking)
+        self.tracks = tracks
         self.estimator = solve.PoseEstimator(env)
         self.running = True
 
@@ -51,50 +95,53 @@ class TagProcessThread(threading.Thread):
             if frame is None:
                 break
 
-            begin_time = time.time()
-            detections = self.detector.detect(frame.image)
-            after_detect = time.time()
-            estimates = self.estimator.solve(frame.calibration, detections)
-            after_solve = time.time()
-
-            result = FrameResult(
-                frame=frame,
-                detections=detections,
-                estimates=estimates,
-                timings=ProcessTimings(
-                    detect=after_detect - begin_time,
-                    solve=after_solve - after_detect
-                )
-            )
-
-            timings = result.timings
-
-            # Annotate the frame with infos
-            for tag in result.detections:
-                cv2.aruco.drawDetectedMarkers(frame.image, numpy.array([tag.corners]), numpy.array([tag.id]))
-            def put_text(text: str, pos, color):
-                cv2.putText(frame.image, text, pos, cv2.FONT_HERSHEY_SIMPLEX, 1, color, 2)
-            put_text(frame.camera, (5, 40), (255, 255, 64))
-            put_text("FPS: " + str(frame.rate), (5, 80), (64, 255, 64))
-            put_text(f"Detect: {timings.detect * 1000 :.2f} ms", (5, 120), (64, 255, 64))
-            put_text(f"Solve: {timings.solve * 1000 :.2f} ms", (5, 160), (64, 255, 64))
-
-            est = result.estimates
-            if est is None:
-                put_text(f"No estimates this frame :(", (5, 200), (64, 255, 64))
-            else:
-                a = est.pose_a
-                b = est.pose_b
-
-                def format_pose(pose):
-                    if pose is None:
-                        return "None"
-                    
-                    tx = pose[0].translation()
-                    return f"{tx.X():.2f}, {tx.Y():.2f}, {tx.Z():.2f} | e {pose[1]:.4f}"
-
-                put_text(f"Est A: {format_pose(a)}", (5, 200), (64, 255, 64))
-                put_text(f"Est B: {format_pose(b)}", (5, 240), (64, 255, 64))
-
+            result = process_frame(self.detectors[frame.camera], self.estimator, frame, self.tracks.get(frame.camera))
             self.result_queue.put(result)
         print("Stopping process thread")
+
+# Keeps worker_count process threads running, so the load controller can
+# change how many there are. Stopped threads finish the frame they're on.
+class TagThreadPool(threading.Thread):
+    worker_count: int
+    workers: list[TagProcessThread]
+    running: bool
+
+    def __init__(self, aruco_dict: int, env: config.SharedEnvironment, cameras: list[config.CameraSettings], worker_count: int, frame_queue: frame_buffer.FrameBuffer, result_queue: queue.PriorityQueue[FrameResult]):
+        threading.Thread.__init__(self)
+        self.aruco_dict = aruco_dict
+        self.env = env
+        self.cameras = cameras
+        self.worker_count = worker_count
+        self.frame_queue = frame_queue
+        self.result_queue = result_queue
+        self.tracking = create_tracking(cameras)
+        self.tracks = create_pose_tracks(cameras)
+        self.workers = []
+        self.changed = threading.Event()
+        self.running = True
+
+    def set_worker_count(self, count: int):
+        self.worker_count = count
+        self.changed.set()
+
+    def run(self):
+        stopped = []
+        while self.running:
+            while len(self.workers) < self.worker_count:
+                worker = TagProcessThread(self.aruco_dict, self.env, self.cameras, self.frame_queue, self.result_queue, self.tracking, self.tracks)
+                worker.start()
+                self.workers.append(worker)
+            while len(self.workers) > self.worker_count:
+                worker = self.workers.pop()
+                worker.running = False
+                stopped.append(worker)
+            # Stopped threads are done once they finish their frame, only the
+            # ones still on it need joining at shutdown
+            stopped = [worker for worker in stopped if worker.is_alive()]
+            self.changed.wait(timeout=1)
+            self.changed.clear()
+
+        for worker in self.workers:
+            worker.running = False
+        for worker in self.workers + stopped:
+            worker.join()
@@ -0,0 +1,363 @@
+# Process backend for tag processing. The Python work around detectMarkers
+# (solving and the pose math after it) holds the GIL, so process
+# threads stop scaling well before all cores are busy. Here detection and
+# solving run in worker processes instead:
+#   Dispatcher thread copies each frame into a shared memory slot and sends an
+#   idle worker only the slot index and frame metadata
+#   Workers detect and solve, then send back compact records of plain numbers
+#   Each camera's tracking state and pose seed live here and go to the worker
+#   with the frame, so every worker tracks and seeds from the camera's newest
+#   frame, not its own
+#   Collector thread turns records back into FrameResults, the frame image stays
+#   in its slot until the main thread releases the frame
+#   A worker that dies is replaced, and the frame it was on is dropped
+import multiprocessing
+import numpy
+import queue
+import signal
+import threading
+from multiprocessing import shared_memory
+from wpimath.geometry import *
+
+import capture
+import config
+import detect
+import frame_buffer
+import pose_math
+import process
+import solve
+
+def pack_environment(env: config.TagEnvironment) -> tuple[float, dict[int, tuple]]:
+    tags = {}
+    for tag_id, pose in env.tags.items():
+        tx = pose.translation()
+        q = pose.rotation().getQuaternion()
+        tags[tag_id] = (tx.X(), tx.Y(), tx.Z(), q.W(), q.X(), q.Y(), q.Z())
+    return (env.tag_size, tags)
+
+def unpack_environment(data: tuple[float, dict[int, tuple]], env: config.SharedEnvironment):
+    tag_size, tag_data = data
+    tags = {}
+    for tag_id, (x, y, z, qw, qx, qy, qz) in tag_data.items():
+        tags[tag_id] = Pose3d(Translation3d(x, y, z), Rotation3d(Quaternion(qw, qx, qy, qz)))
+    env.update(tag_size, tags)
+
+def pack_pose(est: tuple[pose_math.Pose, float]) -> tuple:
+    if est is None:
+        return None
+    pose, err = est
+    return tuple(pose.translation) + tuple(pose.quaternion) + (err,)
+
+def unpack_pose(data: tuple) -> tuple[pose_math.Pose, float]:
+    if data is None:
+        return None
+    return (pose_math.Pose(numpy.array(data[0:3]), numpy.array(data[3:7])), data[7])
+
+class SharedFrameRing:
+    slot_count: int
+    slot_size: int
+
+    def __init__(self, slot_count: int, slot_size: int):
+        self.slot_count = slot_count
+        self.slot_size = slot_size
+        self.shm = shared_memory.SharedMemory(create=True, size=slot_count * slot_size)
+        self.free = queue.Queue()
+        for i in range(slot_count):
+            self.free.put(i)
+
+    def acquire(self, timeout: float) -> int:
+        return self.free.get(timeout=timeout)
+
+    def release(self, slot: int):
+        self.free.put(slot)
+
+    def view(self, slot: int, shape: tuple) -> numpy.ndarray:
+        return numpy.ndarray(shape, numpy.uint8, buffer=self.shm.buf, offset=slot * self.slot_size)
+
+    def close(self):
+        try:
+            self.shm.close()
+        except BufferError:
+            # Frames still hold views into the slots, they go away with the process
+            pass
+        self.shm.unlink()
+
+# Stands in for the frame's FramePool so releasing the frame frees its slot
+class RingSlot:
+    def __init__(self, ring: SharedFrameRing, slot: int):
+        self.ring = ring
+        self.slot = slot
+
+    def release(self, image: numpy.ndarray):
+        self.ring.release(self.slot)
+
+def worker_main(shm_name: str, slot_size: int, aruco_dict: int, cameras: list[config.CameraSettings],
+                tasks: multiprocessing.Queue, results: multiprocessing.Queue, env_queue: multiprocessing.Queue):
+    # Ctrl+C goes to the whole process group, the parent stops the workers
+    # with a None task once it's done with them
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    shm = shared_memory.SharedMemory(name=shm_name)
+    calibrations = {camera.name: camera.calibration for camera in cameras}
+    tracking = process.create_tracking(cameras)
+    detectors = process.create_detectors(aruco_dict, cameras, tracking)
+    tracks = process.create_pose_tracks(cameras)
+    env = config.SharedEnvironment(config.TagEnvironment(0.1, {}))
+    estimator = solve.PoseEstimator(env)
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+
+        # Pick up the latest environment before solving
+        try:
+            while True:
+                unpack_environment(env_queue.get_nowait(), env)
+        except queue.Empty:
+            pass
+
+        task_id, slot, camera, shape, scale, timestamp, tracking_state, seed = task
+        tracking[camera].update(tracking_state)
+        track = tracks.get(camera)
+        if track is not None:
+            track.update(seed)
+        frame = capture.CameraFrame(
+            timestamp=timestamp,
+            camera=camera,
+            calibration=calibrations[camera],
+            image=numpy.ndarray(shape, numpy.uint8, buffer=shm.buf, offset=slot * slot_size),
+            rate=0,
+            scale=scale
+        )
+        try:
+            result = process.process_frame(detectors[camera], estimator, frame, track)
+        except Exception as e:
+            # Still has to report back so the slot gets freed
+            print(camera, "processing failed:", e)
+            result = process.FrameResult(frame, [], None, process.ProcessTimings(detect=0, solve=0))
+
+        est = result.estimates
+        results.put((
+            task_id,
+            [(tag.id, tag.corners) for tag in result.detections],
+            None if est is None else (pack_pose(est.pose_a), pack_pose(est.pose_b), est.seeded),
+            result.timings.detect,
+            result.timings.solve,
+            result.timings.scale,
+            result.timings.queued,
+            tracking[camera].get(),
+            None if track is None else track.get()
+        ))
+        # Views into the shared memory have to be gone before it can be closed
+        del frame, result
+
+    shm.close()
+
+class ProcessWorkerPool(threading.Thread):
+    frame_queue: frame_buffer.FrameBuffer
+    running: bool
+
+    # max_workers processes are started up front, but only worker_count of
+    # them are given frames at once, so set_worker_count doesn't need to
+    # spawn a process while running
+    def __init__(self, aruco_dict: int, env: config.SharedEnvironment, cameras: list[config.CameraSettings], worker_count: int, frame_queue: frame_buffer.FrameBuffer, result_queue: queue.PriorityQueue, max_workers: int = None):
+        threading.Thread.__init__(self)
+        self.aruco_dict = aruco_dict
+        self.env = env
+        self.cameras = cameras
+        self.worker_count = worker_count
+        self.process_count = max(worker_count, max_workers or worker_count)
+        self.frame_queue = frame_queue
+        self.result_queue = result_queue
+        self.running = True
+
+        # Slots are sized for the largest camera; two per worker keeps every
+        # worker busy while the main thread still holds finished frames
+        self.slot_size = max(int(res[0]) * int(res[1]) * 3 for res in (camera.calibration.resolution for camera in cameras))
+        self.slot_count = self.process_count * 2 + 2
+        # Frames out with a worker, and which worker, by task ID
+        self.pending = {}
+        self.next_task_id = 0
+        self.sent_env_version = None
+        self.tracking = process.create_tracking(cameras)
+        self.tracks = process.create_pose_tracks(cameras)
+        # Only hand out a frame when a worker is free to take it, so waiting
+        # frames stay in the frame queue where stale ones get dropped. Also
+        # guards pending.
+        self.busy_workers = set()
+        self.busy_cond = threading.Condition()
+        self.workers = []
+        self.task_queues = []
+        self.env_queues = []
+
+    def set_worker_count(self, count: int):
+        with self.busy_cond:
+            self.worker_count = min(count, self.process_count)
+            self.busy_cond.notify_all()
+
+    # Returns the index of an idle worker, or None if there wasn't one in time
+    def acquire_worker(self, timeout: float) -> int:
+        with self.busy_cond:
+            if not self.busy_cond.wait_for(lambda: len(self.busy_workers) < self.worker_count, timeout):
+                return None
+            worker = next(i for i in range(self.process_count) if i not in self.busy_workers)
+            self.busy_workers.add(worker)
+            return worker
+
+    def release_worker(self, worker: int):
+        with self.busy_cond:
+            self.busy_workers.discard(worker)
+            self.busy_cond.notify_all()
+
+    def start_worker(self, ctx, index: int, ring: SharedFrameRing, results: multiprocessing.Queue):
+        tasks = ctx.Queue()
+        env_queue = ctx.Queue()
+        # Starts from the current environment, later ones come from send_environment
+        env_queue.put(pack_environment(self.env.get()))
+        worker = ctx.Process(
+            target=worker_main,
+            args=(ring.shm.name, self.slot_size, self.aruco_dict, self.cameras, tasks, results, env_queue),
+            daemon=True)
+        worker.start()
+        if index < len(self.workers):
+            self.workers[index] = worker
+            self.task_queues[index] = tasks
+            self.env_queues[index] = env_queue
+        else:
+            self.workers.append(worker)
+            self.task_queues.append(tasks)
+            self.env_queues.append(env_queue)
+
+    # A worker that crashed (a segfault in OpenCV, say) never reports back, so
+    # its frame is dropped, freeing the slot, and a new worker takes its place
+    def replace_dead_workers(self, ctx, ring: SharedFrameRing, results: multiprocessing.Queue):
+        for i, worker in enumerate(self.workers):
+            if worker.is_alive():
+                continue
+            print("Process worker", i, "died with exit code", worker.exitcode, "starting a new one")
+            with self.busy_cond:
+                lost = [task_id for task_id, (owner, _) in self.pending.items() if owner == i]
+                frames = [self.pending.pop(task_id)[1] for task_id in lost]
+            for frame in frames:
+                # A frame that's never finished would hold up its camera in the
+                # frame queue until it's forgotten
+                self.frame_queue.finish(frame)
+                frame.release()
+            self.start_worker(ctx, i, ring, results)
+            self.release_worker(i)
+
+    # Forwards each new snapshot to the workers, which swap in their own copy
+    def send_environment(self):
+        env = self.env.get()
+        if env.version == self.sent_env_version:
+            return
+        self.sent_env_version = env.version
+
+        data = pack_environment(env)
+        for env_queue in self.env_queues:
+            env_queue.put(data)
+
+    def collect(self, results: multiprocessing.Queue):
+        while self.running:
+            try:
+                task_id, tags, estimates, detect_time, solve_time, detect_scale, queued, tracking_state, seed = results.get(timeout=1)
+            except queue.Empty:
+                continue
+
+            with self.busy_cond:
+                entry = self.pending.pop(task_id, None)
+            if entry is None:
+                # Its worker was taken for dead and the frame already dropped
+                continue
+            worker, frame = entry
+            self.release_worker(worker)
+            self.tracking[frame.camera].update(tracking_state)
+            if seed is not None:
+                self.tracks[frame.camera].update(seed)
+            result = process.FrameResult(
+                frame=frame,
+                detections=[detect.DetectedTag(tag_id, corners) for tag_id, corners in tags],
+                estimates=None if estimates is None else solve.EstimatePair(
+                    pose_a=unpack_pose(estimates[0]),
+                    pose_b=unpack_pose(estimates[1]),
+                    seeded=estimates[2]
+                ),
+                timings=process.ProcessTimings(
+                    detect=detect_time,
+                    solve=solve_time,
+                    scale=detect_scale,
+                    queued=queued
+                )
+            )
+            self.result_queue.put(result)
+
+    def run(self):
+        print("Starting", self.process_count, "process workers,", self.worker_count, "active")
+        ring = SharedFrameRing(self.slot_count, self.slot_size)
+
+        # Spawn instead of fork, forking after NT and the capture threads have started is unsafe
+        ctx = multiprocessing.get_context("spawn")
+        results = ctx.Queue()
+        self.sent_env_version = self.env.get().version
+        for i in range(self.process_count):
+            self.start_worker(ctx, i, ring, results)
+
+        collector = threading.Thread(target=self.collect, args=(results,), daemon=True)
+        collector.start()
+
+        while self.running:
+            self.replace_dead_workers(ctx, ring, results)
+            self.send_environment()
+
+            worker = self.acquire_worker(timeout=1)
+            if worker is None:
+                continue
+            try:
+                frame = self.frame_queue.get(timeout=1)
+            except queue.Empty:
+                self.release_worker(worker)
+                continue
+
+            # Wait for the main thread to hand back a slot
+            slot = None
+            while slot is None and self.running:
+                try:
+                    slot = ring.acquire(timeout=1)
+                except queue.Empty:
+                    pass
+            if slot is None:
+                frame.release()
+                break
+
+            shape = frame.image.shape
+            if frame.image.nbytes > self.slot_size:
+                print(frame.camera, "frame is larger than its calibrated resolution, skipping")
+                frame.release()
+                ring.release(slot)
+                self.release_worker(worker)
+                continue
+
+            numpy.copyto(ring.view(slot, shape), frame.image)
+            # The camera's buffer can be reused now, the frame lives in the slot from here on
+            encoded = frame.encoded
+            frame.release()
+            frame.image = ring.view(slot, shape)
+            frame.encoded = encoded
+            frame.pool = RingSlot(ring, slot)
+            frame.refs = 1
+
+            task_id = self.next_task_id
+            self.next_task_id += 1
+            with self.busy_cond:
+                self.pending[task_id] = (worker, frame)
+            track = self.tracks.get(frame.camera)
+            self.task_queues[worker].put((task_id, slot, frame.camera, shape, frame.scale, frame.timestamp,
+                                          self.tracking[frame.camera].get(), None if track is None else track.get()))
+
+        for tasks in self.task_queues:
+            tasks.put(None)
+        for worker in self.workers:
+            worker.join(timeout=5)
+        collector.join()
+        ring.close()
+        print("Stopped process workers")
@@ -0,0 +1,91 @@
+# Puts each camera's results back in capture order before they're published.
+# Process threads finish frames in whatever order they happen to, so a newer
+# frame can come back before an older one from the same camera. A result is
+# held while an older frame of its camera is still being processed, but only
+# for up to the deadline, so a slow or lost frame can't hold up the camera.
+# Results older than one already published are thrown away.
+import heapq
+
+import frame_buffer
+import process
+
+class CameraReorder:
+    # Sequence number of the last published result
+    last_seq: int
+    # (seq, arrival time, result)
+    held: list[tuple[int, float, process.FrameResult]]
+    reordered: int
+    discarded: int
+
+    def __init__(self):
+        self.last_seq = -1
+        self.held = []
+        self.reordered = 0
+        self.discarded = 0
+
+class ReorderBuffer:
+    cameras: dict[str, CameraReorder]
+
+    # deadline is in seconds, 0 publishes everything as it arrives, only
+    # throwing away results that are already out of date
+    def __init__(self, frame_queue: frame_buffer.FrameBuffer, deadline: float):
+        self.frame_queue = frame_queue
+        self.deadline = deadline
+        self.cameras = {}
+
+    def get_camera(self, camera: str) -> CameraReorder:
+        state = self.cameras.get(camera)
+        if state is None:
+            state = CameraReorder()
+            self.cameras[camera] = state
+        return state
+
+    # Returns the results that can be published now, in order. Discarded
+    # results have their frames released.
+    def push(self, result: process.FrameResult, now: float) -> list[process.FrameResult]:
+        frame = result.frame
+        self.frame_queue.finish(frame)
+        state = self.get_camera(frame.camera)
+        if frame.seq <= state.last_seq:
+            state.discarded += 1
+            frame.release()
+            return self.release_due(state, frame.camera, now)
+
+        if self.frame_queue.is_processing_before(frame.camera, frame.seq):
+            state.reordered += 1
+        heapq.heappush(state.held, (frame.seq, now, result))
+        return self.release_due(state, frame.camera, now)
+
+    # Releases whatever has passed its deadline without a new result coming in
+    def poll(self, now: float) -> list[process.FrameResult]:
+        ready = []
+        for camera, state in self.cameras.items():
+            if len(state.held) != 0:
+                ready += self.release_due(state, camera, now)
+        return ready
+
+    # Soonest time a held result will be released by poll, or None
+    def next_deadline(self) -> float:
+        times = [arrival + self.deadline for state in self.cameras.values() for _, arrival, _ in state.held]
+        return min(times) if len(times) != 0 else None
+
+    def release_due(self, state: CameraReorder, camera: str, now: float) -> list[process.FrameResult]:
+        # A result past its deadline goes out along with everything older,
+        # even if it's not first in line
+        overdue = max((seq for seq, arrival, _ in state.held if now - arrival >= self.deadline), default=-1)
+        ready = []
+        while len(state.held) != 0:
+            seq, _, result = state.held[0]
+            if seq > overdue and self.frame_queue.is_processing_before(camera, seq):
+                break
+            heapq.heappop(state.held)
+            state.last_seq = seq
+            ready.append(result)
+        if len(ready) != 0:
+            # Anything older that's still processing is out of date when it arrives
+            self.frame_queue.forget_before(camera, state.last_seq)
+        return ready
+
+    def get_stats(self, camera: str) -> tuple[int, int]:
+        state = self.get_camera(camera)
+        return (state.reordered, state.discarded)
@@ -0,0 +1,114 @@
+# Replays the tag detections from a .ttlog through the pose solver and
+# publishes the results, so the solve and publish path can be run without cameras
+import time
+
+import capture
+import config
+import nt_io
+import output_logger
+import process
+import solve
+
+class ReplayRateCounter:
+    # Same per-second counting as CameraInputThread, but in log time
+    def __init__(self):
+        self.fps = 0
+        self.count = 0
+        self.prev_time = None
+
+    def count_frame(self, timestamp: float) -> int:
+        if self.prev_time is None:
+            self.prev_time = timestamp
+        self.count += 1
+        while timestamp - self.prev_time > 1:
+            self.fps = self.count
+            self.count = 0
+            self.prev_time += 1
+        return self.fps
+
+def run_replay(conf: config.TagTrackerConfig, log_file: str, fast: bool, offline: bool):
+    if conf.environment is not None:
+        tag_env = config.SharedEnvironment(config.load_environment(conf.environment))
+    else:
+        tag_env = config.SharedEnvironment(config.TagEnvironment(0.1, {}))
+    nt = nt_io.NetworkTablesIO(conf.networktables, connect=not offline)
+    if not offline:
+        nt.listen_environment(tag_env)
+    estimator = solve.PoseEstimator(tag_env)
+
+    calibrations = {camera.name: camera.calibration for camera in conf.cameras}
+    tracks = process.create_pose_tracks(conf.cameras)
+    rate_counters = {}
+    unknown_cameras = set()
+
+    print("Replaying", log_file, "as fast as possible" if fast else "in real time")
+    frame_count = 0
+    estimate_count = 0
+    solve_time = 0
+    log_start = None
+    replay_start = time.monotonic()
+    try:
+        for event in output_logger.read_log(log_file):
+            if event.event_id == output_logger.EVENT_MATCH_INFO:
+                print("Match info:", output_logger.unpack_match_info(event.data))
+                continue
+            if event.event_id != output_logger.EVENT_TAG_DETECTS:
+                continue
+
+            calibration = calibrations.get(event.camera)
+            if calibration is None:
+                if event.camera not in unknown_cameras:
+                    print("No calibration for camera", event.camera, "in config, skipping its frames")
+                    unknown_cameras.add(event.camera)
+                continue
+
+            if log_start is None:
+                log_start = event.timestamp
+            if not fast:
+                # Wait until the same time has passed as when it was logged
+                delay = (replay_start + (event.timestamp - log_start)) - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+
+            if event.camera not in rate_counters:
+                rate_counters[event.camera] = ReplayRateCounter()
+            rate = rate_counters[event.camera].count_frame(event.timestamp)
+
+            detections = output_logger.unpack_tag_detects(event.data)
+
+            # Frame is treated as if it was captured just now, so the published
+            # latency only covers the replayed part of the pipeline
+            frame = capture.CameraFrame(
+                timestamp=time.monotonic(),
+                camera=event.camera,
+                calibration=calibration,
+                image=None,
+                rate=rate
+            )
+            begin_time = time.time()
+            # Log time, so warm starts see the same frame gaps as when it was recorded
+            estimates = estimator.solve(calibration, detections, tracks.get(event.camera), event.timestamp)
+            after_solve = time.time()
+
+            nt.publish_output(process.FrameResult(
+                frame=frame,
+                detections=detections,
+                estimates=estimates,
+                timings=process.ProcessTimings(
+                    detect=0,
+                    solve=after_solve - begin_time
+                )
+            ))
+
+            frame_count += 1
+            if estimates is not None:
+                estimate_count += 1
+            solve_time += after_solve - begin_time
+    except KeyboardInterrupt as _:
+        print("Interrupted...")
+    nt.close()
+
+    elapsed = time.monotonic() - replay_start
+    print(f"Replayed {frame_count} frames ({estimate_count} with estimates) in {elapsed:.3f} s")
+    if frame_count != 0:
+        print(f"{frame_count / elapsed:.1f} frames/s, average solve {solve_time / frame_count * 1000:.3f} ms")
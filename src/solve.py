@@ -1,22 +1,28 @@
 import cv2
 import math
 import numpy
+import threading
 from dataclasses import dataclass
 from wpimath.geometry import *
 
 import config
 import detect
+import pose_math
 
 @dataclass
 class EstimatePair:
-    pose_a: tuple[Pose3d, float]
-    pose_b: tuple[Pose3d, float]
+    pose_a: tuple[pose_math.Pose, float]
+    pose_b: tuple[pose_math.Pose, float]
+    # Whether the camera's last pose was used to solve it
+    seeded: bool = False
 
 # OpenCV tvec and rvec (from perspective of camera) are +X right, +Y down, +Z forward 
 # WPI coordinates (from perspective of identity pose): +X forward, +Y left, +Z up
 # So mapping is (wpi_x, wpi_y, wpi_z) = (cv_z, -cv_x, -cv_y)
 
-# Converts OpenCV tvec and rvec to WPI transform from camera to tag
+# Converts OpenCV tvec and rvec to WPI transform from camera to tag. Solving
+# uses pose_math.cv_to_wpi, this wpimath version is what bench_pose_math.py
+# checks it against.
 def cvToWpi(tvec: numpy.typing.NDArray[numpy.float64], rvec: numpy.typing.NDArray[numpy.float64]) -> Pose3d:
     return Pose3d(
         Translation3d(tvec[2][0], -tvec[0][0], -tvec[1][0]),
@@ -30,111 +36,245 @@ def cvToWpi(tvec: numpy.typing.NDArray[numpy.float64], rvec: numpy.typing.NDArra
 def wpiToCv(tx: Translation3d) -> list[float]:
     return [-tx.Y(), -tx.Z(), tx.X()]
 
+# Tag corners relative to the tag's center, (y, z) in the tag's WPI space
+def tag_corner_offsets(half_sz: float) -> list[tuple[float, float]]:
+    return [(half_sz, -half_sz), (-half_sz, -half_sz), (-half_sz, half_sz), (half_sz, half_sz)]
+
+# A seed is at most a frame's movement away, so a handful of iterations is plenty
+SEED_REFINE_CRITERIA = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_COUNT, 10, 1e-6)
+
+# Pose solved for the newest frame of a camera so far, in the space its
+# object points were in. tag_set is None if that frame had no pose worth
+# seeding from.
+@dataclass(frozen=True)
+class PoseSeed:
+    tag_set: tuple
+    env_version: int
+    rvec: numpy.ndarray
+    tvec: numpy.ndarray
+    timestamp: float
+
+# Seeds a camera's next solve when the same tags are seen again soon after,
+# see config.SolverConfig. One per camera, shared by every worker solving its
+# frames like detect.CameraTracking, and likewise only moves forward.
+class PoseTrack:
+    conf: config.SolverConfig
+    seed: PoseSeed
+
+    def __init__(self, conf: config.SolverConfig):
+        self.conf = conf
+        self.lock = threading.Lock()
+        self.seed = PoseSeed(None, None, None, None, -math.inf)
+
+    def get(self) -> PoseSeed:
+        return self.seed
+
+    def update(self, seed: PoseSeed):
+        with self.lock:
+            if seed.timestamp > self.seed.timestamp:
+                self.seed = seed
+
+    # Returns the seed for a frame, or None if it's not from an older frame
+    # with the same tags within max_frame_gap
+    def get_seed(self, tag_set: tuple, env_version: int, timestamp: float) -> PoseSeed:
+        seed = self.seed
+        if (seed.tag_set == tag_set and seed.env_version == env_version
+                and 0 < timestamp - seed.timestamp <= self.conf.max_frame_gap):
+            return seed
+        return None
+
+    def set_pose(self, tag_set: tuple, env_version: int, rvec: numpy.ndarray, tvec: numpy.ndarray, timestamp: float):
+        self.update(PoseSeed(tag_set, env_version, rvec.copy(), tvec.copy(), timestamp))
+
+    # Older frames can't seed anything after this one
+    def reset(self, timestamp: float):
+        self.update(PoseSeed(None, None, None, None, timestamp))
+
 class PoseEstimator:
-    env: config.TagEnvironment
+    env: config.SharedEnvironment
+    # Field space corners of every tag in CV axes, indexed by tag ID, and which
+    # IDs are in the environment. Built from the environment at corners_version.
+    tag_corners: numpy.typing.NDArray[numpy.float64]
+    tag_known: numpy.typing.NDArray[numpy.bool_]
+    # Field to tag poses, also indexed by tag ID
+    tag_translations: numpy.typing.NDArray[numpy.float64]
+    tag_rotations: numpy.typing.NDArray[numpy.float64]
+    corners_version: int
 
-    def __init__(self, env: config.TagEnvironment):
+    def __init__(self, env: config.SharedEnvironment):
         self.env = env
+        self.corners_version = None
+
+    # Only runs when the environment changes, so every frame after can get
+    # its object points with one gather
+    def update_tag_corners(self, env: config.TagEnvironment):
+        tags = env.tags
+        half_sz = env.tag_size / 2.0
+
+        size = max(tags.keys()) + 1 if len(tags) != 0 else 0
+        tag_translations = numpy.zeros((size, 3))
+        tag_rotations = numpy.tile(numpy.eye(3), (size, 1, 1))
+        tag_known = numpy.zeros(size, numpy.bool_)
+        for tag_id, tag_pose in tags.items():
+            tx = tag_pose.translation()
+            q = tag_pose.rotation().getQuaternion()
+            tag_translations[tag_id] = (tx.X(), tx.Y(), tx.Z())
+            tag_rotations[tag_id] = pose_math.quaternion_to_matrix(numpy.array([q.W(), q.X(), q.Y(), q.Z()]))
+            tag_known[tag_id] = True
+
+        # Corners in each tag's space, then in field space, then in CV axes
+        offsets = numpy.array([[0.0, y, z] for y, z in tag_corner_offsets(half_sz)])
+        corners = tag_translations[:, None, :] + offsets @ tag_rotations.transpose(0, 2, 1)
+        tag_corners = corners @ pose_math.CV_TO_WPI
+
+        self.tag_corners = tag_corners
+        self.tag_known = tag_known
+        self.tag_translations = tag_translations
+        self.tag_rotations = tag_rotations
+        self.half_sz = half_sz
+        self.corners_version = env.version
+
+    # With a track, the pose is refined from the camera's last one when possible
+    # and the track is updated, timestamp is the frame's
+    def solve(self, calibration: config.CalibrationInfo, detections: list[detect.DetectedTag], track: PoseTrack = None, timestamp: float = 0) -> EstimatePair:
+        # The same snapshot for the whole frame, even if a new one is swapped in meanwhile
+        env = self.env.get()
+        if self.corners_version != env.version:
+            self.update_tag_corners(env)
+        if len(detections) == 0:
+            return None
+
+        # Find which of the detected tags are in the environment
+        ids = numpy.array([tag_info.id for tag_info in detections])
+        known = ids < len(self.tag_known)
+        known[known] = self.tag_known[ids[known]]
+        tag_ids = ids[known]
+        half_sz = self.half_sz
+
+        # Object points are the corner positions in CV camera space, image
+        # points are the pixel coordinates of the same corners. Important: the
+        # indices all align.
+        object_points = self.tag_corners[tag_ids].reshape(-1, 3)
+        image_points = [detections[i].corners.reshape(4, 2) for i in numpy.flatnonzero(known)]
+        image_points = numpy.concatenate(image_points) if len(image_points) != 0 else None
+
+        if len(tag_ids) == 0:
+            # No known tags were found, we can't estimate anything this frame
+            return None
+
+        tag_set = tuple(sorted(tag_ids.tolist()))
+        env_version = env.version
+        seed = track.get_seed(tag_set, env_version, timestamp) if track is not None else None
 
-    def solve(self, calibration: config.CalibrationInfo, detections: list[detect.DetectedTag]) -> EstimatePair:
-        # Collect the corner positions of all the detected tags in field space
-        half_sz = self.env.tag_size / 2.0
-        object_points = []
-        image_points = []
-        tag_ids = []
-        tag_poses = []
-        for tag_info in detections:
-            tag_pose = self.env.get_tag_pose(tag_info.id)
-            if tag_pose:
-                # Get corner positions in field space
-                corner_0 = tag_pose + Transform3d(Translation3d(0, half_sz, -half_sz), Rotation3d())
-                corner_1 = tag_pose + Transform3d(Translation3d(0, -half_sz, -half_sz), Rotation3d())
-                corner_2 = tag_pose + Transform3d(Translation3d(0, -half_sz, half_sz), Rotation3d())
-                corner_3 = tag_pose + Transform3d(Translation3d(0, half_sz, half_sz), Rotation3d())
-                
-                # Put all the things in the lists
-                # Important: the indices all align in the lists
-
-                # Object points are the corner positions in CV camera space
-                object_points += [
-                    wpiToCv(corner_0.translation()),
-                    wpiToCv(corner_1.translation()),
-                    wpiToCv(corner_2.translation()),
-                    wpiToCv(corner_3.translation())
-                ]
-                # Image points are the pixel coordinates of the corners of the tags
-                image_points += [
-                    [tag_info.corners[0][0][0], tag_info.corners[0][0][1]],
-                    [tag_info.corners[0][1][0], tag_info.corners[0][1][1]],
-                    [tag_info.corners[0][2][0], tag_info.corners[0][2][1]],
-                    [tag_info.corners[0][3][0], tag_info.corners[0][3][1]]
-                ]
-                tag_ids.append(tag_info.id)
-                tag_poses.append(tag_pose)
-        
         if len(tag_ids) == 1:
             # Use tag local space for corner positions
             object_points = numpy.array([[-half_sz, half_sz, 0.0],
                                          [half_sz, half_sz, 0.0],
                                          [half_sz, -half_sz, 0.0],
                                          [-half_sz, -half_sz, 0.0]])
+            tag_id = tag_ids[0]
+
             try:
                 # rvecs and tvecs transform from camera position to (0, 0, 0) in the space object_points is in
                 # In this case that is tag space, so they transform camera to tag
                 _, rvecs, tvecs, errors = cv2.solvePnPGeneric(
-                    object_points, numpy.array(image_points),
+                    object_points, image_points,
                     calibration.matrix, calibration.distortion_coeffs, flags=cv2.SOLVEPNP_IPPE_SQUARE)
             except Exception as e:
                 print(e)
                 return None
 
-            # Calculate WPILib camera poses
-
-            # Calculate transforms from camera to each potential tag pose
-            camera_to_tag_pose_0 = cvToWpi(tvecs[0], rvecs[0])
-            camera_to_tag_pose_1 = cvToWpi(tvecs[1], rvecs[1])
-            camera_to_tag_0 = Transform3d(camera_to_tag_pose_0.translation(), camera_to_tag_pose_0.rotation())
-            camera_to_tag_1 = Transform3d(camera_to_tag_pose_1.translation(), camera_to_tag_pose_1.rotation())
+            if seed is not None:
+                # IPPE is already quicker than refining the seed would be, but
+                # the seed still says which of the two solutions is the right one
+                best = min(range(len(rvecs)), key=lambda i: pose_math.rotation_angle(seed.rvec, rvecs[i]))
+                if numpy.linalg.norm(tvecs[best] - seed.tvec) <= track.conf.max_jump:
+                    track.set_pose(tag_set, env_version, rvecs[best], tvecs[best], timestamp)
+                    return EstimatePair(
+                        pose_a=(self.single_tag_pose(tag_id, tvecs[best], rvecs[best]), errors[best][0]),
+                        pose_b=None,
+                        seeded=True
+                    )
 
-            # Combine transforms to find camera pose in field space
-            # Camera to tag is inverted so overall transform is
-            # field to tag + tag to camera = field to camera
-            field_to_tag_pose = tag_poses[0]
-            field_to_camera_0 = field_to_tag_pose.transformBy(camera_to_tag_0.inverse())
-            field_to_camera_1 = field_to_tag_pose.transformBy(camera_to_tag_1.inverse())
-
-            # Convert back into Pose3d
-            field_to_camera_pose_0 = Pose3d(field_to_camera_0.translation(), field_to_camera_0.rotation())
-            field_to_camera_pose_1 = Pose3d(field_to_camera_1.translation(), field_to_camera_1.rotation())
+            if track is not None:
+                # Only seed the next frame with a solution that's clearly the right one
+                if errors[0][0] <= track.conf.max_ambiguity * errors[1][0]:
+                    track.set_pose(tag_set, env_version, rvecs[0], tvecs[0], timestamp)
+                else:
+                    track.reset(timestamp)
 
             return EstimatePair(
-                pose_a=(field_to_camera_pose_0, errors[0][0]),
-                pose_b=(field_to_camera_pose_1, errors[1][0])
+                pose_a=(self.single_tag_pose(tag_id, tvecs[0], rvecs[0]), errors[0][0]),
+                pose_b=(self.single_tag_pose(tag_id, tvecs[1], rvecs[1]), errors[1][0])
             )
-        elif len(tag_ids) > 1:
+        else:
             # Multiple tags were found, solve with all of them at once
-            try:
-                # object_points are in field space, so this finds camera to field transform
-                _, rvecs, tvecs, errors = cv2.solvePnPGeneric(
-                    numpy.array(object_points), numpy.array(image_points),
-                    calibration.matrix, calibration.distortion_coeffs, flags=cv2.SOLVEPNP_SQPNP)
-            except Exception as e:
-                print(e)
-                return None
-            
-            # WPI-ify and invert so it is field to camera
-            camera_to_field_pose = cvToWpi(tvecs[0], rvecs[0])
-            camera_to_field = Transform3d(camera_to_field_pose.translation(), camera_to_field_pose.rotation())
-            field_to_camera = camera_to_field.inverse() # camera to field -> field to camera
-            field_to_camera_pose = Pose3d(field_to_camera.translation(), field_to_camera.rotation())
+            refined = None
+            if seed is not None:
+                refined = self.solve_seeded(calibration, object_points, image_points, track.conf, seed)
+
+            if refined is not None:
+                rvec, tvec, error = refined
+            else:
+                try:
+                    # object_points are in field space, so this finds camera to field transform
+                    _, rvecs, tvecs, errors = cv2.solvePnPGeneric(
+                        object_points, image_points,
+                        calibration.matrix, calibration.distortion_coeffs, flags=cv2.SOLVEPNP_SQPNP)
+                except Exception as e:
+                    print(e)
+                    return None
+                rvec, tvec, error = rvecs[0], tvecs[0], errors[0][0]
+
+            if track is not None:
+                track.set_pose(tag_set, env_version, rvec, tvec, timestamp)
 
             return EstimatePair(
-                pose_a=(field_to_camera_pose, errors[0][0]),
+                pose_a=(self.multi_tag_pose(tvec, rvec), error),
                 # No estimate B here, ambiguity should have already been resolved by having
                 # multiple tags to sample, since OpenCV will find the set of possibilities
                 # that best match each other
-                pose_b=None
+                pose_b=None,
+                seeded=refined is not None
             )
-        else:
-            # No known tags were found, we can't estimate anything this frame
-            return None
\ No newline at end of file
+
+    # Camera pose in field space from a camera to tag solution for one tag
+    def single_tag_pose(self, tag_id: int, tvec: numpy.ndarray, rvec: numpy.ndarray) -> pose_math.Pose:
+        field_to_tag = (self.tag_translations[tag_id], self.tag_rotations[tag_id])
+        # Transform from camera to the tag, in WPI axes
+        camera_to_tag = pose_math.cv_to_wpi(tvec, rvec)
+
+        # Combine transforms to find camera pose in field space
+        # Camera to tag is inverted so overall transform is
+        # field to tag + tag to camera = field to camera
+        return pose_math.to_pose(*pose_math.compose(*field_to_tag, *pose_math.invert(*camera_to_tag)))
+
+    # Camera pose in field space from a camera to field solution
+    def multi_tag_pose(self, tvec: numpy.ndarray, rvec: numpy.ndarray) -> pose_math.Pose:
+        # WPI-ify and invert so it is field to camera
+        camera_to_field = pose_math.cv_to_wpi(tvec, rvec)
+        return pose_math.to_pose(*pose_math.invert(*camera_to_field))
+
+    # Refines the seed pose against this frame's corners, which takes
+    # a few virtual visual servoing iterations instead of a full solve. Returns
+    # rvec, tvec and RMS reprojection error, or None if the result moved too
+    # far to trust.
+    def solve_seeded(self, calibration: config.CalibrationInfo, object_points: numpy.ndarray, image_points: numpy.ndarray, conf: config.SolverConfig, seed: PoseSeed) -> tuple[numpy.ndarray, numpy.ndarray, float]:
+        rvec = seed.rvec.copy()
+        tvec = seed.tvec.copy()
+        try:
+            # Refined in place. Starting this close, VVS converges in a few
+            # iterations, the LM refiners and solvePnP's ITERATIVE keep going
+            # until they're slower than a full SQPNP solve.
+            cv2.solvePnPRefineVVS(object_points, image_points, calibration.matrix, calibration.distortion_coeffs,
+                                  rvec, tvec, SEED_REFINE_CRITERIA)
+        except Exception as e:
+            print(e)
+            return None
+
+        projected, _ = cv2.projectPoints(object_points, rvec, tvec, calibration.matrix, calibration.distortion_coeffs)
+        # Same error solvePnPGeneric gives
+        error = math.sqrt(numpy.mean(numpy.square(projected.reshape(-1, 2) - image_points)))
+        if error > conf.max_reprojection_error or numpy.linalg.norm(tvec - seed.tvec) > conf.max_jump:
+            return None
+        return (rvec, tvec, error)
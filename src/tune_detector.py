@@ -0,0 +1,148 @@
+# Sweeps detector parameter profiles over a directory of frames written by
+# FrameRecorder and reports detect time against recall and corner accuracy, to
+# find the fastest profile that still sees every tag. Run from the repository root:
+#   python3 src/tune_detector.py recordings/webcam_<uid>/ [-c config.json] [-n webcam] [-s 1.0,0.5] [--sweep]
+#
+# There is no ground truth in a recording, so the tags found by the reference
+# profile (-r, "accurate" by default) are taken as the truth. Recall is the
+# fraction of those each profile also finds, corner error is how far its
+# corners are from the reference ones in full resolution pixels.
+import cv2
+import itertools
+import json
+import numpy
+import time
+from argparse import ArgumentParser
+
+import capture
+import config
+import detect
+import frame_pool
+
+# Parameters --sweep tries every combination of, on top of the named profiles
+SWEEP_PARAMS = {
+    "adaptive-thresh-win-size-max": [15, 23, 33],
+    "adaptive-thresh-win-size-step": [5, 10],
+    "min-marker-perimeter-rate": [0.01, 0.03, 0.05],
+    "corner-refinement-method": ["none", "subpix"]
+}
+
+def load_frames(path: str, decode: config.DecodeConfig, max_frames: int) -> list[cv2.Mat]:
+    source = capture.FrameDirectorySource(config.SourceConfig(type="frames", path=path, realtime=False, loop=False))
+    source.open(None)
+    pool = frame_pool.FramePool(0)
+
+    frames = []
+    while len(frames) < max_frames:
+        ret, data, _ = source.read(pool)
+        if not ret:
+            break
+        # Decoded the same way the camera would at runtime
+        frames.append(capture.decode_frame(data, decode, pool))
+    return frames
+
+def create_detector(aruco_dict: int, camera: config.CameraSettings, name: str, params: dict, scale: float) -> detect.TagDetector:
+    return detect.TagDetector(aruco_dict, config.DetectorConfig(
+        tracking=False,
+        roi_padding=camera.detector.roi_padding,
+        full_scan_interval=camera.detector.full_scan_interval,
+        scale=scale,
+        refine_window=camera.detector.refine_window,
+        profile=name,
+        params=params
+    ))
+
+def run_detector(detector: detect.TagDetector, frames: list[cv2.Mat]) -> tuple[list[dict[int, numpy.ndarray]], float]:
+    found = []
+    total_time = 0
+    for image in frames:
+        start = time.perf_counter()
+        detections = detector.detect(image)
+        total_time += time.perf_counter() - start
+        found.append({tag.id: tag.corners.reshape(4, 2) for tag in detections})
+    return (found, total_time / max(len(frames), 1))
+
+# Compares one profile's detections with the reference ones. Returns recall,
+# mean corner error and the number of tags the reference didn't see.
+def score(found: list[dict], reference: list[dict], pixel_scale: int) -> tuple[float, float, int]:
+    expected = 0
+    matched = 0
+    extra = 0
+    error = 0
+    for frame_found, frame_ref in zip(found, reference):
+        expected += len(frame_ref)
+        for tag_id, corners in frame_found.items():
+            ref_corners = frame_ref.get(tag_id)
+            if ref_corners is None:
+                extra += 1
+                continue
+            matched += 1
+            error += numpy.linalg.norm(corners - ref_corners, axis=1).mean() * pixel_scale
+    recall = matched / expected if expected != 0 else 1.0
+    return (recall, error / max(matched, 1), extra)
+
+def sweep_profiles() -> dict[str, dict]:
+    profiles = {}
+    keys = list(SWEEP_PARAMS.keys())
+    for values in itertools.product(*SWEEP_PARAMS.values()):
+        params = dict(zip(keys, values))
+        name = "sweep-" + "-".join(str(value) for value in values)
+        profiles[name] = params
+    return profiles
+
+def main():
+    parser = ArgumentParser(description="Detector parameter profile tuner")
+    parser.add_argument("frames", type=str, help="Directory of recorded frames")
+    parser.add_argument("-c", "--config", type=str, default="config.json", help="Path to config JSON")
+    parser.add_argument("-n", "--camera", type=str, default=None, help="Camera whose decode and detector settings to use, the first one if not set")
+    parser.add_argument("-r", "--reference", type=str, default="accurate", help="Profile whose detections are taken as ground truth")
+    parser.add_argument("-s", "--scales", type=str, default="1.0", help="Comma separated detector scales to try each profile at")
+    parser.add_argument("-m", "--max-frames", type=int, default=200, help="Most frames to load")
+    parser.add_argument("--min-recall", type=float, default=1.0, help="Recall a profile needs to be recommended")
+    parser.add_argument("--sweep", action="store_true", help="Also try every combination of SWEEP_PARAMS")
+    args = parser.parse_args()
+
+    conf = config.load_config(args.config)
+    profiles = dict(conf.detector_profiles)
+    if args.sweep:
+        profiles.update(sweep_profiles())
+    if args.reference not in profiles:
+        raise ValueError("Unknown reference profile " + args.reference)
+
+    camera = conf.cameras[0]
+    if args.camera is not None:
+        camera = next(c for c in conf.cameras if c.name == args.camera)
+    aruco_dict = cv2.aruco.DICT_APRILTAG_36H11 if conf.tag_family == "36h11" else cv2.aruco.DICT_APRILTAG_16H5
+
+    frames = load_frames(args.frames, camera.decode, args.max_frames)
+    if len(frames) == 0:
+        print("No frames in", args.frames)
+        return
+
+    reference, _ = run_detector(create_detector(aruco_dict, camera, args.reference, profiles[args.reference], 1.0), frames)
+    tag_count = sum(len(tags) for tags in reference)
+    print(f"{len(frames)} frames, reference profile {args.reference} found {tag_count} tags")
+
+    results = []
+    for name, params in profiles.items():
+        for scale in [float(s) for s in args.scales.split(",")]:
+            found, detect_time = run_detector(create_detector(aruco_dict, camera, name, params, scale), frames)
+            recall, error, extra = score(found, reference, camera.decode.scale)
+            results.append((detect_time, name, scale, recall, error, extra))
+
+    results.sort()
+    print(f"{'profile':40} scale  detect (ms)  recall  corner err (px)  extra")
+    for detect_time, name, scale, recall, error, extra in results:
+        print(f"{name:40} {scale:5.2f} {detect_time * 1000:12.2f} {recall:7.3f} {error:16.3f} {extra:6}")
+
+    best = next((r for r in results if r[3] >= args.min_recall), None)
+    if best is None:
+        print("No profile reached a recall of", args.min_recall)
+        return
+    detect_time, name, scale, recall, error, extra = best
+    print(f"\nFastest with recall >= {args.min_recall}: {name} at scale {scale} ({detect_time * 1000:.2f} ms)")
+    print("For \"detector-profiles\" in the config:")
+    print(json.dumps({name: profiles[name]}, indent=4))
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,12 @@
+import asyncio
 import cv2
 import math
-import socketserver
 import threading
 import time
 
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from dataclasses import dataclass
 from io import BytesIO
+from urllib.parse import parse_qs, urlsplit
 from PIL import Image
 
 import config
@@ -35,106 +36,446 @@ overview_html = """
 </html>
 """
 rescale_width = 640
+max_fps = 30
+default_quality = 75
+# Every different query gets its own encoder, so there has to be a limit
+max_variants = 16
+# Seconds an encoder can go without clients before it's stopped, freeing its
+# thread and its place in max_variants
+idle_timeout = 10
 
-class StreamHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
-        allow_reuse_address = True
-        daemon_threads = True
+# What a client asked to see. Clients asking for the same variant share the
+# encoded JPEGs.
+@dataclass(frozen=True)
+class StreamVariant:
+    camera: str # None for the mosaic of every camera
+    width: int # Of each tile for the mosaic, so it's as wide as it always was by default
+    quality: int
+    grayscale: bool
+
+# Scales an image to width, keeping the aspect ratio. Frames are never scaled up.
+def resize_to_width(image: cv2.Mat, width: int) -> cv2.Mat:
+    if width >= image.shape[1]:
+        return image
+    height = max(1, int(width * (image.shape[0] / image.shape[1])))
+    return cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA)
+
+def convert_for_variant(image: cv2.Mat, variant: StreamVariant) -> cv2.Mat:
+    if variant.grayscale and image.ndim == 3:
+        return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    if not variant.grayscale and image.ndim == 2:
+        return cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+    return image
+
+# Lays the camera images out in a square grid, each scaled to tile_width
+def build_mosaic(images: list[cv2.Mat], tile_width: int, grayscale: bool) -> Image.Image:
+    per_edge = math.ceil(math.sqrt(len(images)))
+    grid = []
+    heights = [0] * per_edge
+    total_height = 0
+    for row in range(per_edge):
+        cols = []
+        max_height = 0
+        for col in range(per_edge):
+            idx = row * per_edge + col
+            if idx < len(images):
+                image = cv2.resize(images[idx], (tile_width, int(tile_width * (images[idx].shape[0] / images[idx].shape[1]))), interpolation=cv2.INTER_AREA)
+                if grayscale:
+                    image = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+                else:
+                    image = cv2.cvtColor(image, cv2.COLOR_GRAY2RGB if image.ndim == 2 else cv2.COLOR_BGR2RGB)
+                max_height = max(max_height, image.shape[0])
+                cols.append(image)
+            else:
+                cols.append(None)
+        grid.append(cols)
+        heights[row] = max_height
+        total_height += max_height
+
+    mosaic = Image.new("L" if grayscale else "RGB", (tile_width * per_edge, total_height))
+    y = 0
+    for row in range(per_edge):
+        for col in range(per_edge):
+            image = grid[row][col]
+            if image is None:
+                continue
+            piece = Image.fromarray(grid[row][col])
+            x = col * tile_width
+            mosaic.paste(piece, (x, y))
+        y += heights[row]
+    return mosaic
+
+# Encodes one stream variant once for every client watching it. Each new JPEG
+# gets the next version number, and the server wakes the clients waiting for
+# a version they haven't sent yet. Does nothing while no one is watching, and
+# stops once the server evicts it.
+class StreamEncoder(threading.Thread):
+    server: "StreamServer"
+    variant: StreamVariant
+    # Only added to through StreamServer.add_client
+    client_count: int
+    # When the last client left
+    last_used: float
+    running: bool
+    jpeg: bytes
+    version: int
+    # Frame version the JPEG was encoded from
+    source_version: int
+
+    def __init__(self, server: "StreamServer", variant: StreamVariant):
+        threading.Thread.__init__(self, daemon=True)
+        self.server = server
+        self.variant = variant
+        self.cond = threading.Condition()
+        self.client_count = 0
+        self.last_used = time.monotonic()
+        self.running = True
+        self.jpeg = None
+        self.version = 0
+        self.source_version = 0
+
+    def add_client(self):
+        with self.cond:
+            self.client_count += 1
+            self.cond.notify_all()
+
+    def remove_client(self):
+        with self.cond:
+            self.client_count -= 1
+            self.last_used = time.monotonic()
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+
+    # Latest JPEG with its version and the frame version it was encoded from
+    def get_jpeg(self) -> tuple[int, int, bytes]:
+        with self.cond:
+            return (self.version, self.source_version, self.jpeg)
+
+    def encode(self, images: list[cv2.Mat]) -> bytes:
+        variant = self.variant
+        if variant.camera is None:
+            stream = BytesIO()
+            build_mosaic(images, variant.width, variant.grayscale).save(stream, format="JPEG", quality=variant.quality)
+            return stream.getvalue()
+
+        image = convert_for_variant(resize_to_width(images[0], variant.width), variant)
+        _, data = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, variant.quality])
+        return data.tobytes()
+
+    def run(self):
+        encoded_version = None
+        encode_time = 0
+        while self.running:
+            with self.cond:
+                self.cond.wait_for(lambda: self.client_count != 0 or not self.running, timeout=idle_timeout)
+                idle = self.client_count == 0
+            if not self.running:
+                break
+            if idle:
+                self.server.evict_if_idle(self)
+                continue
+
+            frames = self.server.wait_frames(self.variant.camera, encoded_version, timeout=1)
+            if frames is None:
+                # Check for clients again
+                continue
+            frames_version, images = frames
+
+            data = self.encode(images)
+            with self.cond:
+                self.jpeg = data
+                self.version += 1
+                self.source_version = frames_version
+            self.server.notify_encoded(self)
+            encoded_version = frames_version
+
+            # Cameras publish separately, so the mosaic could otherwise be
+            # encoded once for every camera's frame
+            delay = encode_time + 1 / max_fps - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            encode_time = time.monotonic()
 
 class StreamServer(threading.Thread):
     conf: config.StreamConfig
     frames: dict[str, cv2.Mat]
+    # Bumped whenever any camera publishes, and per camera
+    frames_version: int
+    camera_versions: dict[str, int]
+    encoders: dict[StreamVariant, StreamEncoder]
 
-    def __init__(self, conf: config.StreamConfig):
+    def __init__(self, conf: config.StreamConfig, cameras: list[str]):
         threading.Thread.__init__(self, daemon=True)
         self.conf = conf
+        self.cameras = cameras
         self.frames = {}
+        self.frames_version = 0
+        self.camera_versions = {}
+        self.lock = threading.Lock()
+        self.frames_cond = threading.Condition(self.lock)
+        self.encoders = {}
+        self.loop = None
+        # Set when the encoder has a new JPEG, only used on the event loop
+        self.encoded_events = {}
+
+    # Whether anyone is watching the camera, through its own stream or the mosaic
+    def has_clients(self, camera: str) -> bool:
+        for variant, encoder in list(self.encoders.items()):
+            if encoder.client_count != 0 and (variant.camera is None or variant.camera == camera):
+                return True
+        return False
+
+    # Adds a client to the variant's encoder, starting one if needed, and
+    # returns it. The client has to call remove_client on it when it's done.
+    # At max_variants the least recently used idle encoder makes room, and
+    # if every encoder has clients this returns None.
+    def add_client(self, variant: StreamVariant) -> StreamEncoder:
+        with self.lock:
+            encoder = self.encoders.get(variant)
+            if encoder is None:
+                if len(self.encoders) >= max_variants:
+                    idle = [e for e in self.encoders.values() if e.client_count == 0]
+                    if len(idle) == 0:
+                        return None
+                    self.evict(min(idle, key=lambda e: e.last_used))
+                encoder = StreamEncoder(self, variant)
+                encoder.start()
+                self.encoders[variant] = encoder
+            # Under the lock, so an encoder can't be evicted between being
+            # looked up and getting its client
+            encoder.add_client()
+            return encoder
 
+    # Call with the lock held
+    def evict(self, encoder: StreamEncoder):
+        del self.encoders[encoder.variant]
+        encoder.stop()
+        # Drops its event from encoded_events
+        self.notify_encoded(encoder)
+
+    # Called from encoder threads once they've been idle for a while
+    def evict_if_idle(self, encoder: StreamEncoder):
+        with self.lock:
+            if encoder.client_count == 0 and time.monotonic() - encoder.last_used >= idle_timeout and self.encoders.get(encoder.variant) is encoder:
+                self.evict(encoder)
+
+    # The stream keeps the image until the camera's next frame, so it must
+    # not be changed or reused after this
     def publish_frame(self, camera: str, frame: cv2.Mat):
-        self.frames[camera] = frame
-
-    def create_handler(ss_self):
-        class StreamRequestHandler(BaseHTTPRequestHandler):
-            def send_html(self, html: str):
-                content = html.encode("utf-8")
-                self.send_response(200)
-                self.send_header("Content-Type", "text/html")
-                self.send_header("Content-Length", str(len(content)))
-                self.end_headers()
-                self.wfile.write(content)
-            
-            def do_GET(self):
-                if self.path == "/":
-                    self.send_html(overview_html)
-                elif self.path == "/stream.mjpg":
-                    self.send_response(200)
-                    self.send_header("Age", "0")
-                    self.send_header("Cache-Control", "no-cache, private")
-                    self.send_header("Pragma", "no-cache")
-                    self.send_header("Content-Type", "multipart/x-mixed-replace; boundary=FRAME")
-                    self.end_headers()
-                    try:
-                        while True:
-                            rescaled_images = []
-                            for _, image in ss_self.frames.items():
-                                image_h, image_w = image.shape[0], image.shape[1]
-                                image = cv2.resize(image, (rescale_width, int(rescale_width * (image_h / image_w))), interpolation=cv2.INTER_LINEAR)
-                                image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-                                rescaled_images.append(image)
-                            if len(rescaled_images) == 0:
-                                time.sleep(0.1)
-                                continue
-
-                            per_edge = math.ceil(math.sqrt(len(rescaled_images)))
-                            grid = []
-                            heights = [0] * per_edge
-                            total_height = 0
-                            for row in range(per_edge):
-                                cols = []
-                                max_height = 0
-                                for col in range(per_edge):
-                                    idx = row * per_edge + col
-                                    if idx < len(rescaled_images):
-                                        image = rescaled_images[idx]
-                                        max_height = max(max_height, image.shape[0])
-                                        cols.append(image)
-                                    else:
-                                        cols.append(None)
-                                grid.append(cols)
-                                heights[row] = max_height
-                                total_height += max_height
-
-                            mosaic = Image.new("RGB", (rescale_width * per_edge, total_height))
-                            y = 0
-                            for row in range(per_edge):
-                                for col in range(per_edge):
-                                    image = grid[row][col]
-                                    if image is None:
-                                        continue
-                                    piece = Image.fromarray(grid[row][col])
-                                    x = col * rescale_width
-                                    mosaic.paste(piece, (x, y))
-                                y += heights[row]
-
-                            stream = BytesIO()
-                            mosaic.save(stream, format="JPEG")
-                            frame_data = stream.getvalue()
-
-                            self.wfile.write(b"--FRAME\r\n")
-                            self.send_header("Content-Type", "image/jpeg")
-                            self.send_header("Content-Length", str(len(frame_data)))
-                            self.end_headers()
-                            self.wfile.write(frame_data)
-                            self.wfile.write(b"\r\n")
-                            time.sleep(1/30) # Limit to 30fps streaming
-                    except Exception as e:
-                        print("Streaming ended: ", str(e))
-                else:
-                    self.send_error(404)
-                    self.end_headers()
-        
-        return StreamRequestHandler
+        with self.lock:
+            self.frames[camera] = frame
+            self.frames_version += 1
+            self.camera_versions[camera] = self.frames_version
+            self.frames_cond.notify_all()
 
-    def run(self):
-        server = StreamHTTPServer(("", self.conf.port), self.create_handler())
+    def get_frames_version(self, camera: str) -> int:
+        with self.lock:
+            if camera is None:
+                return self.frames_version
+            return self.camera_versions.get(camera, 0)
+
+    # Waits for a frame from camera (or any camera if None) published after
+    # seen_version. Returns the version and the latest images, or None on timeout.
+    def wait_frames(self, camera: str, seen_version: int, timeout: float) -> tuple[int, list[cv2.Mat]]:
+        def version():
+            if camera is None:
+                return self.frames_version if len(self.frames) != 0 else None
+            return self.camera_versions.get(camera)
+
+        with self.frames_cond:
+            if not self.frames_cond.wait_for(lambda: version() is not None and version() != seen_version, timeout):
+                return None
+            if camera is None:
+                return (self.frames_version, list(self.frames.values()))
+            return (self.camera_versions[camera], [self.frames[camera]])
+
+    # Called from encoder threads
+    def notify_encoded(self, encoder: StreamEncoder):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.set_encoded, encoder)
+
+    def set_encoded(self, encoder: StreamEncoder):
+        event = self.encoded_events.pop(encoder, None)
+        if event is not None:
+            event.set()
+
+    # Waits until the encoder has a new JPEG or the timeout passes
+    async def wait_encoded(self, encoder: StreamEncoder, timeout: float):
+        event = self.encoded_events.get(encoder)
+        if event is None:
+            event = asyncio.Event()
+            self.encoded_events[encoder] = event
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    # Picks the variant from ?width=, ?quality= and ?gray=. Returns None if
+    # they don't make sense.
+    def parse_variant(self, camera: str, query: dict) -> StreamVariant:
+        try:
+            width = int(query.get("width", [rescale_width])[0])
+            quality = int(query.get("quality", [default_quality])[0])
+        except ValueError:
+            return None
+        if width < 16 or quality < 1 or quality > 100:
+            return None
+        return StreamVariant(
+            camera=camera,
+            width=width,
+            quality=quality,
+            grayscale=query.get("gray", ["0"])[0] in ("1", "true")
+        )
+
+    async def send_response(self, writer: asyncio.StreamWriter, status: str, headers: dict[str, str], body: bytes = b""):
+        head = "HTTP/1.1 " + status + "\r\n"
+        for name, value in headers.items():
+            head += name + ": " + value + "\r\n"
+        writer.write(head.encode("latin-1") + b"\r\n" + body)
+        await writer.drain()
+
+    async def send_error(self, writer: asyncio.StreamWriter, status: str):
+        body = status.encode("latin-1")
+        await self.send_response(writer, status, {
+            "Content-Type": "text/plain",
+            "Content-Length": str(len(body)),
+            "Connection": "close"
+        }, body)
+
+    async def send_snapshot(self, writer: asyncio.StreamWriter, encoder: StreamEncoder):
+        frames_version = self.get_frames_version(encoder.variant.camera)
+        # Wait for a JPEG of a newer frame than when the request came in.
+        # If the camera stopped, send whatever was encoded last.
+        deadline = time.monotonic() + 1
+        while True:
+            _, source_version, frame_data = encoder.get_jpeg()
+            remaining = deadline - time.monotonic()
+            if (frame_data is not None and source_version > frames_version) or remaining <= 0:
+                break
+            await self.wait_encoded(encoder, remaining)
+
+        if frame_data is None:
+            await self.send_error(writer, "503 Service Unavailable")
+            return
+        await self.send_response(writer, "200 OK", {
+            "Cache-Control": "no-cache, private",
+            "Content-Type": "image/jpeg",
+            "Content-Length": str(len(frame_data)),
+            "Connection": "close"
+        }, frame_data)
+
+    async def send_stream(self, writer: asyncio.StreamWriter, encoder: StreamEncoder, client_fps: float):
+        await self.send_response(writer, "200 OK", {
+            "Age": "0",
+            "Cache-Control": "no-cache, private",
+            "Pragma": "no-cache",
+            "Content-Type": "multipart/x-mixed-replace; boundary=FRAME",
+            "Connection": "close"
+        })
+        try:
+            sent_version = None
+            sent_time = 0
+            while True:
+                delay = sent_time + 1 / client_fps - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+
+                version, _, frame_data = encoder.get_jpeg()
+                if frame_data is None or version == sent_version:
+                    await self.wait_encoded(encoder, 1)
+                    continue
+
+                writer.write(b"--FRAME\r\nContent-Type: image/jpeg\r\nContent-Length: " + str(len(frame_data)).encode() + b"\r\n\r\n")
+                writer.write(frame_data)
+                writer.write(b"\r\n")
+                # Waits while the client is still receiving earlier frames, then
+                # the latest JPEG gets sent, skipping any encoded in between
+                await writer.drain()
+                sent_version = version
+                sent_time = time.monotonic()
+        except (ConnectionError, asyncio.IncompleteReadError) as e:
+            print("Streaming ended: ", str(e))
+
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 10)
+            method, path, _ = request.split(b"\r\n", 1)[0].decode("latin-1").split(" ", 2)
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ConnectionError, ValueError):
+            writer.close()
+            return
+
+        try:
+            await self.handle_request(writer, method, path)
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def handle_request(self, writer: asyncio.StreamWriter, method: str, path: str):
+        if method != "GET":
+            await self.send_error(writer, "405 Method Not Allowed")
+            return
+
+        url = urlsplit(path)
+        query = parse_qs(url.query)
+        if url.path == "/":
+            content = overview_html.encode("utf-8")
+            await self.send_response(writer, "200 OK", {
+                "Content-Type": "text/html",
+                "Content-Length": str(len(content)),
+                "Connection": "close"
+            }, content)
+            return
+
+        # /stream.mjpg is the mosaic, /camera/<name>.mjpg or .jpg is one camera
+        if url.path == "/stream.mjpg":
+            camera = None
+            snapshot = False
+        elif url.path.startswith("/camera/") and (url.path.endswith(".mjpg") or url.path.endswith(".jpg")):
+            camera, ext = url.path[len("/camera/"):].rsplit(".", 1)
+            snapshot = ext == "jpg"
+            if camera not in self.cameras:
+                await self.send_error(writer, "404 Not Found")
+                return
+        else:
+            await self.send_error(writer, "404 Not Found")
+            return
+
+        variant = self.parse_variant(camera, query)
+        # Clients can ask for fewer frames with ?fps=
+        try:
+            client_fps = min(float(query.get("fps", [max_fps])[0]), max_fps)
+            if client_fps <= 0:
+                raise ValueError()
+        except ValueError:
+            variant = None
+        if variant is None:
+            await self.send_error(writer, "400 Bad Request")
+            return
+
+        encoder = self.add_client(variant)
+        if encoder is None:
+            await self.send_error(writer, "503 Service Unavailable")
+            return
+        try:
+            if snapshot:
+                await self.send_snapshot(writer, encoder)
+            else:
+                await self.send_stream(writer, encoder, client_fps)
+        finally:
+            encoder.remove_client()
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        server = await asyncio.start_server(self.handle_client, None, self.conf.port, reuse_address=True)
         print("Streaming on port", self.conf.port)
-        server.serve_forever()
+        async with server:
+            await server.serve_forever()
+
+    # Every client is served from one event loop on this thread. Encoding
+    # happens on the encoder threads, so clients only ever wait on sockets.
+    def run(self):
+        asyncio.run(self.serve())